@@ -1,10 +1,19 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import logging
+import os
 import pathlib
 import numpy as np
 import pandas as pd
 
 from ete3 import NCBITaxa
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = pacsv = None
+
 # CONSTANTS
 OFFICIAL_RANKS = [
     "superkingdom",
@@ -22,15 +31,91 @@ column_dtypes = {
     "genome_id": "string",
 }
 
+# Positions of the genome_summary columns that are used, mapped to the names
+# they get in the stats data frame. Ordered as they appear in the output.
+summary_columns = {
+    0: "genome_id",
+    1: "genome_name",
+    2: "taxid",
+    3: "genome_status",
+    16: "completeness",
+    17: "contamination",
+    14: "coarse_consistency",
+    15: "fine_consistency",
+}
+
+summary_dtypes = {
+    0: "string",
+    1: "string",
+    2: "string",
+    3: "string",
+    14: "float64",
+    15: "float64",
+    16: "float64",
+    17: "float64",
+}
+
+# Column arrays of the stats used by the filtering rules
+GenomeStats = namedtuple(
+    "GenomeStats",
+    [
+        "genome_id",
+        "completeness",
+        "contamination",
+        "fine_consistency",
+        "is_complete",
+    ],
+)
+
 _logger = logging.getLogger(__name__)
 
 
-def field_to_float(field_string):
-    """Convert a str representation of a float to a float"""
-    if field_string != "":
-        return float(field_string)
-    else:
-        return np.nan
+def read_genome_summary(genome_summary_fp):
+    """Read the used columns of the genome_summary file in a data frame
+
+    The multi-threaded pyarrow csv parser is used if pyarrow is installed,
+    otherwise the pandas C parser.
+
+    Positional arguments:
+      genome_summary_fp: pathlib.Path: Path to the genome_summary file
+
+    Return
+      df: pd.DataFrame: A data frame with the `summary_columns`
+    """
+    if pacsv is not None:
+        # pyarrow selects columns by name, so get them from the header
+        with open(genome_summary_fp, "r") as fin:
+            header = next(fin).rstrip("\n").split("\t")
+        names = {header[i]: name for i, name in summary_columns.items()}
+        types = {
+            header[i]: pa.string() if dtype == "string" else pa.float64()
+            for i, dtype in summary_dtypes.items()
+        }
+        table = pacsv.read_csv(
+            genome_summary_fp,
+            parse_options=pacsv.ParseOptions(delimiter="\t"),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=list(names.keys()),
+                column_types=types,
+                strings_can_be_null=True,
+            ),
+        )
+        df = table.to_pandas(types_mapper={pa.string(): pd.StringDtype()}.get)
+        df.columns = [names[col] for col in df.columns]
+        return df
+
+    df = pd.read_csv(
+        genome_summary_fp,
+        sep="\t",
+        header=0,
+        usecols=list(summary_columns.keys()),
+        dtype=summary_dtypes,
+        na_values=[""],
+    )
+    # usecols returns the columns in file order
+    df.columns = [summary_columns[i] for i in sorted(summary_columns)]
+    df = df.reindex(columns=list(summary_columns.values()))
+    return df
 
 
 def parse_genome_summary(genome_summary_fp, thresh, available_genomes):
@@ -42,55 +127,32 @@ def parse_genome_summary(genome_summary_fp, thresh, available_genomes):
     Positional arguments:
       genome_summary_fp: pathlib.Path: Path to the genome_summary file
       thresh: int: Threshold used for filtering out based on the rule
-      available_genomes: list: List of strings of genome ids that have
-        a genome file
+      available_genomes: iterable: Genome ids (str) that have a genome file
 
     Return
       df: pd.DataFrame: A data frame with the stats per genomes that
         pass this first filtering
     """
-    data = []
-    with open(genome_summary_fp, "r") as fin:
-        next(fin)
-        for line in fin:
-            fields = line.split("\t")
-            genome_id = fields[0]
-            genome_name = fields[1]
-            taxid = fields[2]
-            genome_status = fields[3].lower()
-            coarse_consistency = field_to_float(fields[14])
-            fine_consistency = field_to_float(fields[15])
-            completeness = field_to_float(fields[16])
-            contamination = field_to_float(fields[17])
-
-            if (
-                (completeness and contamination)
-                and (completeness - (5 * contamination) > thresh)
-                and (genome_status in ["complete", "wgs"])
-            ):
-                genome_stats = {
-                    "genome_id": genome_id,
-                    "genome_name": genome_name,
-                    "taxid": taxid,
-                    "genome_status": genome_status,
-                    "completeness": completeness,
-                    "contamination": contamination,
-                    "coarse_consistency": coarse_consistency,
-                    "fine_consistency": fine_consistency,
-                }
-
-                data.append(genome_stats)
-            else:
-                pass
-
-    df = pd.DataFrame.from_records(data)
-
-    _logger.info("Passing genomes : {}".format(genome_summary_fp, df.shape[0]))
+    valid_genomes = frozenset(available_genomes)
+
+    df = read_genome_summary(genome_summary_fp)
+    df["genome_status"] = df.genome_status.str.lower()
     # Convert taxid and genome_id types to string
     # Plays better with the NCBI tree
     df[["taxid", "genome_id"]] = df[["taxid", "genome_id"]].astype(str)
 
-    valid_genomes = set(available_genomes)
+    # A missing completeness or contamination gives a nan score, which
+    # never passes the threshold. Zero values are valid and are kept.
+    score = df.completeness.to_numpy() - 5.0 * df.contamination.to_numpy()
+    passing = (
+        ~np.isnan(score)
+        & (score > thresh)
+        & df.genome_status.isin(["complete", "wgs"]).to_numpy(dtype=bool)
+    )
+    df = df.loc[passing]
+
+    _logger.info("Passing genomes : {}".format(df.shape[0]))
+
     df = df.loc[df.genome_id.isin(valid_genomes)]
 
     if df.shape[0] == 0:
@@ -100,164 +162,201 @@ def parse_genome_summary(genome_summary_fp, thresh, available_genomes):
 
 
 ### FILTERING RULES ###
-def filter_df_on_completeness(in_df):
-    """Get a df or string of the genome id with the highest completeness"""
-    max_completeness = in_df.completeness.max()
-    on_completeness = in_df.loc[
-        in_df.completeness == max_completeness,
-    ]
-    if on_completeness.shape[0] == 1:
-        return on_completeness.genome_id.values[0]
-    else:
-        return on_completeness
+def genome_stats_arrays(df):
+    """Get the columns used by the filtering rules as numpy arrays"""
+    return GenomeStats(
+        genome_id=df.genome_id.to_numpy(),
+        completeness=df.completeness.to_numpy(),
+        contamination=df.contamination.to_numpy(),
+        fine_consistency=df.fine_consistency.to_numpy(),
+        is_complete=(df.genome_status == "complete").to_numpy(dtype=bool),
+    )
 
 
-def filter_df_on_contamination(in_df):
-    """Get a df or string of the genome id with the lowest contamination"""
-    min_contamination = in_df.contamination.min()
-    on_contamination = in_df.loc[
-        in_df.contamination == min_contamination,
-    ]
-    if on_contamination.shape[0] == 1:
-        return on_contamination.genome_id.values[0]
-    else:
-        return on_contamination
+def take_stats(stats, rows):
+    """Get the GenomeStats for the rows (positions or a slice) only"""
+    return stats._make(values[rows] for values in stats)
 
 
 # TO DO
-# Make a function for coarse consistency
+# Add a rule for coarse consistency
 # Once the genome_summary gets fixed
-def filter_df_on_fine_consistency(in_df):
-    """Get a df or string of the genome id with the highest fine consistency"""
+def best_in_group(completeness, contamination, fine_consistency, is_complete):
+    """Get the positions of the rows of a group that pass the filtering rules
 
-    max_fine_consistency = in_df.fine_consistency.min()
-    on_fine_consistency = in_df.loc[
-        in_df.fine_consistency == max_fine_consistency,
-    ]
-    if on_fine_consistency.shape[0] == 1:
-        return on_fine_consistency.genome_id.values[0]
-    else:
-        return on_fine_consistency
+    The rules are applied in order, each on the rows left by the previous:
+      1. Highest completeness
+      2. Lowest contamination
+      3. Lowest fine consistency (skipped if it is missing for all)
+      4. Status complete over wgs
+
+    Positional arguments:
+      completeness: np.ndarray: Completeness values of the group
+      contamination: np.ndarray: Contamination values of the group
+      fine_consistency: np.ndarray: Fine consistency values of the group
+      is_complete: np.ndarray: Boolean array, True if the genome_status is
+        complete
+
+    Return:
+      idx: np.ndarray: Positions of the rows that are left. More than one
+        position means a tie that is resolved with `final_selection`
+    """
+    idx = np.flatnonzero(completeness == completeness.max())
 
+    if idx.size > 1:
+        values = contamination[idx]
+        idx = idx[values == values.min()]
 
-def filter_df_on_status(in_df):
-    """Get a df or string of the genome id with status complete or wgs"""
-    statuses = in_df.genome_status.unique()
+    if idx.size > 1:
+        values = fine_consistency[idx]
+        if not np.isnan(values).all():
+            idx = idx[values == np.nanmin(values)]
 
-    if "complete" in statuses:
-        on_status = in_df.loc[in_df.genome_status == "complete"]
-    else:
-        on_status = in_df.loc[in_df.genome_status == "wgs"]
+    if idx.size > 1 and is_complete[idx].any():
+        idx = idx[is_complete[idx]]
 
-    if on_status.shape[0] == 1:
-        return on_status.genome_id.values[0]
-    else:
-        return on_status
+    return idx
 
 
-def final_selection(status_df, random_state=1234):
+def final_selection(genome_ids, random_state=1234):
     """Get the genome id as string no matter what.
 
     If we reach this step there must be a string instance returned.
     This is done with sampling one genome_id at random.
     The random_state ensures that we always choose the same genome from the
-    same dataframe.
+    same set of genome ids. The choice is the same as the one of
+    pd.DataFrame.sample() on the genome ids sorted.
 
     Positional arguments:
-      status_df: pd.DataFrame: A dataframe that has at least genome_id as
-      column
+      genome_ids: np.ndarray: An array of genome ids (str)
 
     Optional arguments:
-      random_state: int: An integer that controls the random state of
-        pd.DataFrame.sample()
+      random_state: int: Seed for the np.random.RandomState used to sample
 
     Return:
       genome_id : string: A string of the `genome_id`
     """
-    status_df = status_df.sort_values(by="genome_id")
-    genome_id = status_df.sample(
-        1, random_state=random_state
-    ).genome_id.values[0]
+    genome_ids = np.sort(genome_ids)
+    rs = np.random.RandomState(random_state)
+    picked = rs.choice(genome_ids.size, size=1, replace=False)
+    genome_id = genome_ids[picked[0]]
     return genome_id
 
 
-def get_best_genome_id(df):
-    """Filter the df until a genome id is returned as string"""
-    genome_id = np.nan
+def get_best_genome_id(stats):
+    """Apply the filtering rules until a single genome id is left
 
-    while True:
-        genome_id = filter_df_on_completeness(df)
-        if type(genome_id) == str:
-            break
+    Positional arguments:
+      stats: GenomeStats: The column arrays of the candidate genomes, see
+        `genome_stats_arrays`
 
-        genome_id = filter_df_on_contamination(genome_id)
-        if type(genome_id) == str:
-            break
+    Return:
+      genome_id: string: A string of the best `genome_id`
+    """
+    idx = best_in_group(
+        stats.completeness,
+        stats.contamination,
+        stats.fine_consistency,
+        stats.is_complete,
+    )
 
-        genome_id = filter_df_on_fine_consistency(genome_id)
-        if type(genome_id) == str:
-            break
+    if idx.size == 1:
+        return stats.genome_id[idx[0]]
 
-        genome_id = filter_df_on_status(genome_id)
-        if type(genome_id) == str:
-            break
+    return final_selection(stats.genome_id[idx])
 
-        genome_id = final_selection(genome_id)
-        if type(genome_id) == str:
-            break
 
-        if type(genome_id) != str:
-            _logger.error(
-                "No valid genome_id found for taxid: {}".format(genome_id)
-            )
-            _logger.error("Last data seen for it: \n{}".format(genome_id))
-            break
+def index_taxid_rows(best_per_taxid_df):
+    """Map each taxid to the positions of its rows in the df"""
+    return best_per_taxid_df.groupby("taxid").indices
 
-    return genome_id
 
+def cache_descendant_taxids(ncbi_tree):
+    """Cache the descendant taxids of every node in the tree
 
-def select_best_from_tree(tree, best_per_taxid_df):
-    """Select the best genome from a TreeNode instance"""
-    genome_id = np.nan
+    All taxids are laid out once in preorder, so that the descendants of a
+    node form a contiguous span right after it. Each node gets a
+    `_desc_taxids` attribute of the form (preorder_taxids, start, end),
+    which is what `descendant_taxids` reads.
+    """
+    n_descendants = {}
+    for node in ncbi_tree.traverse("postorder"):
+        n_descendants[node] = sum(1 + n_descendants[c] for c in node.children)
 
+    preorder = list(ncbi_tree.traverse("preorder"))
+    taxids = [node.name for node in preorder]
+    for i, node in enumerate(preorder):
+        node._desc_taxids = (taxids, i + 1, i + 1 + n_descendants[node])
+
+    return
+
+
+def descendant_taxids(tree):
+    """Get the taxids of all descendants of a TreeNode, excluding itself"""
+    if hasattr(tree, "_desc_taxids"):
+        taxids, start, end = tree._desc_taxids
+        return taxids[start:end]
+    return [d.name for d in tree.iter_descendants()]
+
+
+def subtree_taxids(tree):
+    """Get the taxids a TreeNode selects genomes from"""
     # Edge case for species-level tree
     if tree.is_leaf():
-        taxids = [tree.name]
-    else:
-        taxids = [d.name for d in tree.iter_descendants()]
-
-    subset_df = best_per_taxid_df.loc[best_per_taxid_df.taxid.isin(taxids)]
-
-    if not subset_df.empty:
-        genome_id = get_best_genome_id(subset_df)
-    else:
-        _logger.debug(
-            "No genome available for tree:{} (rank: {}, taxid: {})".format(
-                tree.sci_name, tree.rank, tree.name
-            )
-        )
+        return [tree.name]
+    return descendant_taxids(tree)
+
+
+def select_best_from_taxids(taxids, stats, taxid_rows):
+    """Select the best genome among the ones of the taxids
+
+    Positional arguments:
+      taxids: list: Taxids (str) to select a genome from
+      stats: GenomeStats: The column arrays of the best_per_taxid_df
+      taxid_rows: dict: The output of `index_taxid_rows` for the
+        best_per_taxid_df
+
+    Return:
+      genome_id: string or np.nan: The best `genome_id`, np.nan if no
+        genome is available for the taxids
+    """
+    genome_id = np.nan
+
+    rows = [taxid_rows[taxid] for taxid in taxids if taxid in taxid_rows]
+
+    if rows:
+        subset = take_stats(stats, np.sort(np.concatenate(rows)))
+        genome_id = get_best_genome_id(subset)
 
     return genome_id
 
 
-def select_best_for_rank(rank_name, ncbi_tree, best_per_taxid_df, lineages_df):
-    """Create a dataframe that holds best genomes for a specified rank"""
+def index_lineages(lineages_df):
+    """Index the lineages_df on genome_id, if it is not already"""
+    if "genome_id" in lineages_df.columns:
+        lineages_df = lineages_df.set_index("genome_id", drop=True)
+    return lineages_df
 
-    rank_trees = ncbi_tree.search_nodes(rank=rank_name)
 
-    genome_ids = []
-    for tree in rank_trees:
-        genome_id = select_best_from_tree(tree, best_per_taxid_df)
-        if genome_id:
-            genome_ids.append(genome_id)
+def join_lineages(df, lineages_df):
+    """Append the lineage of each genome in df
+
+    The genome_id index of the lineages_df is hashed once and reused by
+    every join, instead of merging on the genome_id column each time.
+    Only genomes with a lineage are kept.
+    """
+    return df.join(index_lineages(lineages_df), on="genome_id", how="inner")
+
+
+def rank_genomes_df(rank_name, genome_ids, best_per_taxid_df, lineages_df):
+    """Create a dataframe with the stats and lineages of the genome_ids"""
+    genome_ids = frozenset(genome_ids)
 
     rank_df = best_per_taxid_df.loc[
         best_per_taxid_df.genome_id.isin(genome_ids)
     ]
 
-    rank_lineages = lineages_df.loc[lineages_df.genome_id.isin(genome_ids)]
-
-    rank_complete_df = pd.merge(rank_df, rank_lineages, on="genome_id")
+    rank_complete_df = join_lineages(rank_df, lineages_df)
 
     _logger.info("{} : {}".format(rank_name, rank_complete_df.shape[0]))
 
@@ -273,30 +372,126 @@ def write_rank_df_to_file(rank_df, output_tsv):
 
 ## WRAPPERS
 def select_best_per_taxid(main_df):
-    """Build a dictionary of taxids with their best genome representative"""
+    """Build a dictionary of taxids with their best genome representative
 
-    grouped = main_df.groupby("taxid")
-    best_per_taxid = {}
+    Rows are ranked on completeness (desc), contamination (asc) and fine
+    consistency (asc) and the top row per taxid is kept. Only taxids whose
+    top row is tied on all three go through the full set of filtering rules,
+    see `get_best_genome_id`.
+    """
+    rank_cols = ["completeness", "contamination", "fine_consistency"]
+
+    ranked = main_df.sort_values(
+        by=rank_cols, ascending=[False, True, True], na_position="last"
+    )
+    top = ranked.drop_duplicates(subset="taxid", keep="first")
+
+    # Rows sharing the same stats with another row of the same taxid
+    tied = ranked.duplicated(subset=["taxid"] + rank_cols, keep=False)
+    tied_taxids = set(top.loc[tied.loc[top.index], "taxid"])
+
+    best_per_taxid = dict(zip(top.taxid, top.genome_id))
+
+    if tied_taxids:
+        tied_df = main_df.loc[main_df.taxid.isin(tied_taxids)]
 
-    for taxid in grouped.groups.keys():
-        group = grouped.get_group(taxid)
-        best_per_taxid[taxid] = get_best_genome_id(group)
+        # Lay out the rows of each taxid contiguously and work on the
+        # column arrays, using the group boundaries as offsets
+        codes, taxids = pd.factorize(tied_df.taxid)
+        order = np.argsort(codes, kind="stable")
+        bounds = np.flatnonzero(np.diff(codes[order])) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [order.size]))
+
+        stats = take_stats(genome_stats_arrays(tied_df), order)
+
+        for code, (start, end) in enumerate(zip(starts, ends)):
+            group = take_stats(stats, slice(start, end))
+            best_per_taxid[taxids[code]] = get_best_genome_id(group)
 
     return best_per_taxid
 
 
+# Data shared by the processes of select_best_for_ranks
+_rank_worker_data = {}
+
+
+def _init_rank_worker(best_per_taxid_df, lineages_df):
+    """Load the data needed by _rank_worker once per process"""
+    _rank_worker_data.update(
+        best_per_taxid_df=best_per_taxid_df,
+        lineages_df=lineages_df,
+        taxid_rows=index_taxid_rows(best_per_taxid_df),
+        stats=genome_stats_arrays(best_per_taxid_df),
+    )
+
+
+def _rank_worker(rank_name, rank_subtrees, output_tsv):
+    """Select and write the best genomes for one rank
+
+    rank_subtrees is a list of (taxid, subtree_taxids) tuples, one for
+    every node of the rank
+    """
+    data = _rank_worker_data
+
+    genome_ids = []
+    for taxid, taxids in rank_subtrees:
+        genome_id = select_best_from_taxids(
+            taxids, data["stats"], data["taxid_rows"]
+        )
+        if isinstance(genome_id, str):
+            genome_ids.append(genome_id)
+        else:
+            _logger.debug(
+                "No genome available for taxid: {} (rank: {})".format(
+                    taxid, rank_name
+                )
+            )
+
+    rank_df = rank_genomes_df(
+        rank_name, genome_ids, data["best_per_taxid_df"], data["lineages_df"]
+    )
+    write_rank_df_to_file(rank_df, output_tsv)
+
+    return output_tsv
+
+
 def select_best_for_ranks(
     ncbi_tree, best_per_taxid_df, lineages_df, output_dir
 ):
+    """Write the best genomes for each of the OFFICIAL_RANKS
 
-    for rank in OFFICIAL_RANKS:
-        rank_df = select_best_for_rank(
-            rank, ncbi_tree, best_per_taxid_df, lineages_df
-        )
+    Ranks are processed in parallel. The tree is reduced to the taxids of
+    each subtree in this process, so only these lists and the data frames
+    are sent to the workers.
+    """
+    cache_descendant_taxids(ncbi_tree)
+
+    subtrees = {rank: [] for rank in OFFICIAL_RANKS}
+    for node in ncbi_tree.traverse():
+        rank = getattr(node, "rank", None)
+        if rank in subtrees:
+            subtrees[rank].append((node.name, subtree_taxids(node)))
+
+    output_tsvs = [
+        output_dir / pathlib.Path("best_per_{}.tsv".format(rank))
+        for rank in OFFICIAL_RANKS
+    ]
 
-        output_tsv = output_dir / pathlib.Path("best_per_{}.tsv".format(rank))
-        write_rank_df_to_file(rank_df, output_tsv)
-        _logger.info("{} info written in {}".format(rank, output_tsv))
+    workers = min(len(OFFICIAL_RANKS), os.cpu_count() or 1)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_rank_worker,
+        initargs=(best_per_taxid_df, lineages_df),
+    ) as ex:
+        done = ex.map(
+            _rank_worker,
+            OFFICIAL_RANKS,
+            [subtrees[rank] for rank in OFFICIAL_RANKS],
+            output_tsvs,
+        )
+        for rank, output_tsv in zip(OFFICIAL_RANKS, done):
+            _logger.info("{} info written in {}".format(rank, output_tsv))
 
     return
 
@@ -309,21 +504,38 @@ def select_best(
     thresh,
     output_path,
 ):
+    """Select the best genomes per taxid and per rank and write them
 
-    lineages_df = pd.read_csv(genome_lineage, sep="\t", dtype=column_dtypes)
+    Positional arguments:
+      genome_summary: pathlib.Path: Path to the genome_summary file
+      genome_lineage: pathlib.Path: Path to the genome_lineage file
+      genome_ids: iterable: Genome ids (str) that have a genome file. It is
+        converted once to a frozenset that is used for all lookups
+      ncbi_db: pathlib.Path: Path to the taxa.sqlite created by ete3
+      thresh: int: Threshold for the completeness - 5*contamination rule
+      output_path: pathlib.Path: Directory where all tables are written
 
+    Return:
+      None
+    """
     # genome_name: is there and gets suffixed with _x, _y
     # taxon_id: is present as taxid in the original df
-    # Drop the columns from the lineages_df before merging
-    lineages_df = lineages_df.drop(columns=["taxon_id", "genome_name"])
+    # Skip the columns from the lineages_df so they are not merged
+    lineages_df = pd.read_csv(
+        genome_lineage,
+        sep="\t",
+        usecols=lambda col: col not in ("taxon_id", "genome_name"),
+        dtype=column_dtypes,
+    )
+    lineages_df = index_lineages(lineages_df)
 
+    genome_ids = frozenset(genome_ids)
     filtered_data = parse_genome_summary(genome_summary, thresh, genome_ids)
 
     best_per_taxid = select_best_per_taxid(filtered_data)
+    best_ids = frozenset(best_per_taxid.values())
 
-    best_df = filtered_data.loc[
-        filtered_data.genome_id.isin(best_per_taxid.values())
-    ]
+    best_df = filtered_data.loc[filtered_data.genome_id.isin(best_ids)]
 
     # Create a Series of filepaths
     # local_fp = best_df.apply(lambda x: genome_ids.get(x.genome_id), axis=1)
@@ -332,7 +544,7 @@ def select_best(
     final_df = best_df.copy()
 
     # Append lineages info
-    best_per_taxid_df = pd.merge(final_df, lineages_df, on="genome_id")
+    best_per_taxid_df = join_lineages(final_df, lineages_df)
 
     # Append the local_fp series to the df
     # final_df["local_fp"] = local_fp
@@ -1,6 +1,8 @@
 from concurrent.futures import ProcessPoolExecutor as tPool
+from collections import namedtuple
+from functools import partial
+from itertools import islice
 import multiprocessing as mp
-from Bio import SeqIO
 import gzip
 import pandas as pd
 import pathlib
@@ -17,6 +19,17 @@ supported_suffixes = {
 
 SSU_DESCRIPTIONS = ["16S ribosomal RNA", "SSU rRNA"]
 
+# Block size for copying chunk files
+COPY_BUFSIZE = 1 << 20
+
+# gzip compresslevel of chunk files. Chunks are copied as they are into a
+# gzipped output, so they are compressed as a final file. Otherwise they
+# are decompressed again and written fast rather than small
+OUTPUT_COMPRESSLEVEL = 6
+TRANSIENT_COMPRESSLEVEL = 1
+
+FastaRecord = namedtuple("FastaRecord", ["description", "seq"])
+
 
 def is_gz(fp):
     return fp.name.endswith("gz")
@@ -37,26 +50,34 @@ def optionally_compressed_handle(fp, mode):
 
 
 def load_index(index_path):
-    df = pd.read_csv(index_path, sep="\t", dtype={"genome_id": "string"})
+    """Load an index written by `cirtap index`, as tsv or parquet"""
+    if index_path.suffix == ".parquet":
+        df = pd.read_parquet(index_path)
+        df["genome_id"] = df.genome_id.astype("string")
+    else:
+        df = pd.read_csv(index_path, sep="\t", dtype={"genome_id": "string"})
     return df
 
 
 def select_genome_ids(index_path, on_col):
     """Get a list of genome ids that have a file"""
-    df = pd.read_csv(index_path, sep="\t", dtype={"genome_id": "string"})
+    df = load_index(index_path)
     genome_ids = df.loc[df[on_col] == 1]["genome_id"].tolist()
     assert len(genome_ids) != 0, _logger.critical("No genome ids found")
     return genome_ids
 
 
 def generate_file_list(genomes_dir, genome_ids, target, suffixes_dict):
-    """Get a list of files that are going to be parsed"""
+    """Get an iterator over the files that are going to be parsed
+
+    The target is checked right away, the paths are created lazily
+    """
     if target in suffixes_dict:
         suffix = suffixes_dict[target]
-        files_list = [
+        files_list = (
             genomes_dir / pathlib.Path(f"{genome_id}/{genome_id}.{suffix}")
             for genome_id in genome_ids
-        ]
+        )
     else:
         _logger.critical("Unsupported filetype for set {}".format(target))
         sys.exit(1)
@@ -64,6 +85,51 @@ def generate_file_list(genomes_dir, genome_ids, target, suffixes_dict):
     return files_list
 
 
+class CountingIterator:
+    """Wrap an iterable and count the items taken from it"""
+
+    def __init__(self, iterable):
+        self._it = iter(iterable)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self._it)
+        self.count += 1
+        return item
+
+
+def parse_fasta(handle):
+    """
+    Parse a fasta handle into FastaRecord tuples
+
+    A minimal parser that only keeps the header line (without the `>`)
+    as description and the sequence as a single string. Lines before
+    the first header are ignored.
+
+    Arguments:
+      handle: file obj: An open text handle of a fasta file
+
+    Yield:
+      record: FastaRecord: A (description, seq) namedtuple of strings
+    """
+    description = None
+    lines = []
+    for line in handle:
+        if line.startswith(">"):
+            if description is not None:
+                yield FastaRecord(description, "".join(lines))
+            description = line[1:].rstrip()
+            lines = []
+        elif description is not None:
+            lines.append(line.strip().replace(" ", ""))
+
+    if description is not None:
+        yield FastaRecord(description, "".join(lines))
+
+
 def is_SSU(record):
     """Return true if the record is a 16S sequence based on description"""
     return any(desc in record.description for desc in SSU_DESCRIPTIONS)
@@ -74,22 +140,19 @@ def has_valid_seq(record):
     return len(record.seq) > 1
 
 
-def fasta_reader(fa, q, *filters):
-    # TO DO
-    # Check packing/unpacking
-    # Should this be just a list, even if it's empty?
+def fasta_reader(fa, filters=()):
     """
-    Reader worker for the fa file in the specified q(ueue)
+    Read the records of the fa file that pass the filters
 
     Applies a filter on the sequence length > 1. This
     is there to parse out
     (a) empty sequence strings
     (b) sequences that are only represented as 1
 
-    Parsing is done with Bio.SeqIO.parse()
+    Parsing is done with parse_fasta()
 
     The optional `filters` can be any number of callables that can
-    be applied to a SeqRecord object. Each should return a single
+    be applied to a FastaRecord object. Each should return a single
     boolean True or False, if the record is to be kept. True to
     keep, False to discard. If a record must be kept, all filters
     should return True. If one fails, the record is skipped.
@@ -97,90 +160,58 @@ def fasta_reader(fa, q, *filters):
 
     Arguments:
       fa: Path obj: The Path representation of the fasta to read
-      q: Queue obj: A multiprocessing.Manager.Queue() instance
-      *filters: callables: Filtering rules that apply a test to
-      the record object. They should return a single True or
+      filters: list: Callables with filtering rules that apply a test
+      to the record object. They should return a single True or
       False value.
 
 
     Return:
-        seq_dict: dict: Dictionary that holds seq descriptions as seq ids
-        and sequences.
-        A 'skipped' key is there to also gather sequence ids that were
-        skipped due to the filtering. Of the form
-        {
-            seq.description : sequence,
-                ...,
-            'skipped': [seq.description_1, ...]
-                ...
-        }
+        records: list: A list of (description, sequence) tuples of strings
+        for the records that are kept. The number of records that were
+        skipped due to the filtering is logged
     """
-    seq_dict = {"skipped": []}
-    for record in SeqIO.parse(fa, "fasta"):
-        keep = has_valid_seq(record)
-        if filters and keep is True:
-            keep = all(f(record) for f in filters[0])
-        if keep is True:
-            seq_dict[record.description] = record.seq
-        else:
-            seq_dict["skipped"].append(record.id)
-            pass
+    records = []
+    skipped = 0
+    with optionally_compressed_handle(fa, "r") as fin:
+        for record in parse_fasta(fin):
+            keep = has_valid_seq(record)
+            if filters and keep is True:
+                keep = all(f(record) for f in filters)
+            if keep is True:
+                records.append(record)
+            else:
+                skipped += 1
 
-    q.put(seq_dict)
+    if skipped:
+        _logger.debug("Skipped {} records from {}".format(skipped, fa))
 
-    return seq_dict
-
-
-def writer(q, out_fp):
-    """
-    Writer worker that handles writing to files fed from the reader
-    in the q(ueue)
-
-    out_fp is gzipped to save space.
-
-    Arguments:
-      q: mp.Queue() obj: A queue
-      out_fp: Path obj: Path to output.fa.gz
-
-    Return:
-      -
-    """
-    with gzip.open(out_fp, "wt") as fout:
-        while 1:
-            m = q.get()
-            if m == "kill":
-                break
-            for k, v in m.items():
-                if k == "skipped":
-                    # Used to handle that
-                    pass
-                else:
-                    fout.write(">{}\n{}\n".format(k, v))
-                    fout.flush()
+    return records
 
 
 def chunkify(files_list, chunksize=1000):
     """
-    Create a list of chunks.
+    Yield chunks of the files_list.
 
     Each chunk is a list itself, with size `chunksize`.
 
     Arguments:
-      files_list: list: A list of Path objects
+      files_list: iterable: Path objects
       chunksize: int: Size of each chunk
 
-    Return:
-      chunks: list: A list of lists. Each nested list has size
-        `chunksize`.
+    Yield:
+      chunk: list: A list of Path objects with size `chunksize`. The last
+        one can be smaller.
     """
-    chunks = []
-    for i in range(0, len(files_list), chunksize):
-        chunk = files_list[i : i + chunksize]
-        chunks.append(chunk)
-    return chunks
+    files = iter(files_list)
+    chunk = list(islice(files, chunksize))
+    while chunk:
+        yield chunk
+        chunk = list(islice(files, chunksize))
 
 
-def create_jobs_list(chunks, outdir, *filters):
+def create_jobs_list(
+    chunks, outdir, *filters, first_id=0, compresslevel=TRANSIENT_COMPRESSLEVEL
+):
     # TO DO
     # Figure out the packing/unpacking
     """
@@ -192,6 +223,8 @@ def create_jobs_list(chunks, outdir, *filters):
       filepaths to be processed
       outdir: Path object: The directory where results will be written
       filters: Callables
+      first_id: int: The chunk_id of the first chunk
+      compresslevel: int: gzip compresslevel of the chunk files
 
     Return:
     jobs_list: list: A list of dictionaries that holds information for
@@ -202,12 +235,13 @@ def create_jobs_list(chunks, outdir, *filters):
          'fastas'    : list of Path objects,
                        ([PosixPath('path/to/PATRIC.faa'),...])
          'filters'   : list of functions
+         'compresslevel' : int
         }
       ]
 
     """
     jobs_list = []
-    for i, chunk in enumerate(chunks):
+    for i, chunk in enumerate(chunks, start=first_id):
         chunk_id = f"chunk_{i}"
         chunk_out = f"{chunk_id}.fa.gz"
         out_fp = outdir / pathlib.Path(chunk_out)
@@ -219,55 +253,61 @@ def create_jobs_list(chunks, outdir, *filters):
             "out_fp": out_fp,
             # Should there be an if filters or if len(filters) != 0 ?
             "filters": [f for f in filters],
+            "compresslevel": compresslevel,
         }
 
         jobs_list.append(chunk_dict)
     return jobs_list
 
 
-# https://stackoverflow.com/a/13530258
-def process_chunk(chunk_dict):
+def process_chunk(chunk_dict, readers=3):
     """
     Multiprocessing of a single chunk.
 
-    This spawns 4 processes: 1 is dedicated to writing and 3 are reading.
-    This is to ensure that the file being written is locked.
-    """
-    manager = mp.Manager()
-    q = manager.Queue()
-
-    # TO DO
-    # Avoid hardcoding this value
-    with mp.Pool(4) as mpool:
-        # 1 dedicated process to write
-        watcher = mpool.apply_async(writer, (q, chunk_dict["out_fp"]))
-
-        # The rest 3 are reading
-        jobs = []
-        for fa in chunk_dict["fastas"]:
-            job = mpool.apply_async(
-                fasta_reader, (fa, q, chunk_dict["filters"])
-            )
-            jobs.append(job)
-
-        # Collect results
-        for job in jobs:
-            job.get()
+    This spawns `readers` processes that parse the fastas. Records are
+    streamed back and written by the calling process, so it is the only
+    one that writes to the chunk file.
 
-        q.put("kill")
-        mpool.close()
-        mpool.join()
-
-
-def collect_sequences(files_list, outdir, *filters, nthreads=2):
-    """Start nthreads that each spawns a multiprocessing pool of 4
+    Return:
+      count: int: The number of records written to the chunk file
+    """
+    fastas = chunk_dict["fastas"]
+    chunksize = max(1, len(fastas) // (readers * 4))
+    read_fasta = partial(fasta_reader, filters=chunk_dict["filters"])
+    count = 0
+
+    compresslevel = chunk_dict.get("compresslevel", TRANSIENT_COMPRESSLEVEL)
+    with tPool(readers) as rpool:
+        with gzip.open(
+            chunk_dict["out_fp"], "wt", compresslevel=compresslevel
+        ) as fout:
+            for records in rpool.map(
+                read_fasta, fastas, chunksize=chunksize
+            ):
+                fout.write("".join(">{}\n{}\n".format(*r) for r in records))
+                count += len(records)
+    return count
+
+
+def collect_sequences(
+    files_list, outdir, *filters, nthreads=2, compressed_output=False
+):
+    """Start nthreads that each spawns 3 reader processes
+
+    Each of the nthreads writes its own chunk, so 4 processes are
+    running per thread. Set compressed_output if the chunks are
+    concatenated into a gzipped file, see `concatenate_chunk_files`.
 
-    Yeah, this is weird. Probably a threads-only based thing would
-    be better
+    Return:
+      seq_counter: int: The number of records written to all chunks
     """
+    # Chunks are created as they are submitted, so files_list can be a
+    # generator and is never held in memory as a whole
     chunks = chunkify(files_list)
-
-    job_dicts = create_jobs_list(chunks, outdir, *filters)
+    if compressed_output:
+        compresslevel = OUTPUT_COMPRESSLEVEL
+    else:
+        compresslevel = TRANSIENT_COMPRESSLEVEL
 
     # Restrict cpu usage
     max_cpus = mp.cpu_count()
@@ -286,31 +326,46 @@ def collect_sequences(files_list, outdir, *filters, nthreads=2):
     # see https://stackoverflow.com/a/61470465
     with tPool(use_threads) as tpool:
         counter = 0
-        for i in range(0, len(job_dicts), nthreads):
-            current_jobs = job_dicts[i : i + nthreads]
+        seq_counter = 0
+        current_chunks = list(islice(chunks, nthreads))
+        while current_chunks:
+            current_jobs = create_jobs_list(
+                current_chunks,
+                outdir,
+                *filters,
+                first_id=counter,
+                compresslevel=compresslevel,
+            )
             a = tpool.map(process_chunk, current_jobs)
-            for _ in a:
+            for chunk_count in a:
                 counter += 1
-            _logger.info(
-                "Finished {} / {} chunks".format(counter, len(chunks))
-            )
-    return
+                seq_counter += chunk_count
+            _logger.info("Finished {} chunks".format(counter))
+            current_chunks = list(islice(chunks, nthreads))
+    return seq_counter
 
 
 def concatenate_chunk_files(chunks_dir, output_path, cleanup=True):
-    """Gather all files in one"""
+    """Gather all files in one
+
+    Return:
+      files_counter: int: The number of chunk files concatenated
+    """
     _logger.info("Concatenatating all sequence files")
     files_counter = 0
-    seq_counter = 0
-    with optionally_compressed_handle(output_path, "w") as fout:
+    with open(output_path, "wb") as fout:
         for f in chunks_dir.iterdir():
             files_counter += 1
-            with optionally_compressed_handle(f, "r") as fin:
-                for record in SeqIO.parse(fin, "fasta"):
-                    SeqIO.write(record, fout, "fasta")
-                    seq_counter += 1
+            if is_gz(output_path):
+                # Chunks are gzipped and concatenated gzip members are a
+                # valid gzip file, so they are copied as they are
+                fin = open(f, "rb")
+            else:
+                fin = gzip.open(f, "rb")
+            with fin:
+                shutil.copyfileobj(fin, fout, COPY_BUFSIZE)
     if cleanup is True:
         _logger.info("Removing {}".format(chunks_dir.resolve()))
         shutil.rmtree(chunks_dir)
 
-    return files_counter, seq_counter
+    return files_counter
@@ -1,15 +1,37 @@
+import asyncio
 import os
+import csv
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import ftplib
+import gzip
 import pandas as pd
+import posixpath
+import queue
 import hashlib
 import pathlib
+import zlib
 from io import BytesIO
 
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import aioftp
+except ImportError:
+    aioftp = None
+
 
 # CONSTANTS
 
 PATRIC_FTP = "ftp.patricbrc.org"
 
+# The same tree as the ftp, served over https
+PATRIC_HTTPS = "https://ftp.patricbrc.org"
+
 RELEASE_NOTES_FILES = {
     "genome_summary",
     "genome_metadata",
@@ -17,10 +39,176 @@ RELEASE_NOTES_FILES = {
     "PATRIC_genomes_AMR.txt",
 }
 
+# Replies of servers that do not implement a command, e.g. MLSD
+FTP_NOT_IMPLEMENTED = ("500", "501", "502", "504")
+
 _logger = logging.getLogger(__name__)
 
 # HELPERS
 
+
+class FTPPool:
+    """
+    A fixed number of logged in FTP connections shared between threads.
+
+    Commands on a single connection are serial and each one waits a full
+    round-trip, so independent transfers are spread over `size`
+    connections that are opened once.
+
+    Positional arguments:
+      - host: str: The ftp host to connect to. e.g. 'ftp.patricbrc.org'
+
+    Keyword arguments:
+      - size: int: Number of connections to open
+    """
+
+    def __init__(self, host, size=4):
+        self.size = max(1, size)
+        self._opened = []
+        self._handles = queue.Queue()
+        try:
+            for _ in range(self.size):
+                ftp = ftplib.FTP(host)
+                ftp.login()
+                self._opened.append(ftp)
+                self._handles.put(ftp)
+        except Exception:
+            self.close()
+            raise
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, waiting until one is free"""
+        ftp = self._handles.get()
+        try:
+            yield ftp
+        finally:
+            self._handles.put(ftp)
+
+    def map(self, func, items):
+        """Return a list with func(ftp_handle, item) for all items
+
+        Items are processed in `size` threads, each using its own connection
+        """
+
+        def run(item):
+            with self.connection() as ftp:
+                return func(ftp, item)
+
+        if self.size == 1:
+            return [run(item) for item in items]
+
+        with ThreadPoolExecutor(self.size) as ex:
+            return list(ex.map(run, items))
+
+    def close(self):
+        for ftp in self._opened:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+        self._opened = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def require_httpx():
+    """Raise an ImportError if httpx, needed for https, is not installed"""
+    if httpx is None:
+        raise ImportError(
+            "The https transport requires httpx. "
+            "Install it with `pip install cirtap[https]`"
+        )
+
+
+def open_https_client(size=4):
+    """
+    Open an https client for the PATRIC_HTTPS with up to `size` connections.
+
+    The client speaks HTTP/2, so the GETs of many files are multiplexed
+    over a single connection instead of costing a round-trip per command
+    like on the ftp. It is safe to share between threads.
+
+    This requires httpx, see the `https` extra.
+    """
+    require_httpx()
+    return httpx.Client(
+        base_url=PATRIC_HTTPS,
+        http2=True,
+        limits=httpx.Limits(max_connections=max(1, size)),
+        timeout=httpx.Timeout(60.0),
+    )
+
+
+def require_aioftp():
+    """Raise an ImportError if aioftp, needed for async, is not installed"""
+    if aioftp is None:
+        raise ImportError(
+            "The async backend requires aioftp. "
+            "Install it with `pip install cirtap[async]`"
+        )
+
+
+class AsyncFTPPool:
+    """
+    A fixed number of logged in aioftp clients, for a single coroutine.
+
+    Same as FTPPool, for the asyncio mirror backend. Transfers do not
+    block, so many pools share one thread. Clients are logged in with
+    `open` and logged out with `close`.
+
+    Positional arguments:
+      - host: str: The ftp host to connect to. e.g. 'ftp.patricbrc.org'
+
+    Keyword arguments:
+      - size: int: Number of clients to open
+      - port: int: The ftp port of the host
+    """
+
+    def __init__(self, host, size=1, port=21):
+        require_aioftp()
+        self.host = host
+        self.port = port
+        self.size = max(1, size)
+        self.clients = []
+
+    async def open(self):
+        try:
+            for _ in range(self.size):
+                client = aioftp.Client(socket_timeout=60)
+                self.clients.append(client)
+                await client.connect(self.host, self.port)
+                await client.login()
+        except Exception:
+            await self.close()
+            raise
+        return self
+
+    async def close(self):
+        for client in self.clients:
+            try:
+                await client.quit()
+            except Exception:
+                client.close()
+        self.clients = []
+
+
+def is_missing_genome_error(err):
+    """True for the '550 - Missing dir or permission denied' ftp replies
+
+    Works for the errors of both ftplib and aioftp
+    """
+    if isinstance(err, ftplib.error_perm):
+        return str(err).startswith("550")
+    if aioftp is not None and isinstance(err, aioftp.StatusCodeError):
+        return "550" in err.received_codes
+    return False
+
+
 def get_remote_dir_timestamps(ftp_handle, remote_dir_name, skip_dirs=True):
     """
     Parse the remote timestamps.
@@ -42,7 +230,21 @@ def get_remote_dir_timestamps(ftp_handle, remote_dir_name, skip_dirs=True):
         e.g. { '1234.5.fna' : '20200112235902', ... }
     """
     timestamps_dict = {}
-    for entry in ftp_handle.mlsd(remote_dir_name, facts=["modify", "type"]):
+    try:
+        entries = list(
+            ftp_handle.mlsd(remote_dir_name, facts=["modify", "type"])
+        )
+    except ftplib.error_perm as e:
+        # Only fall back if MLSD is not implemented. Anything else, e.g.
+        # a 550 for a missing dir, is handled by the caller
+        if not str(e).startswith(FTP_NOT_IMPLEMENTED):
+            raise
+        _logger.debug(
+            "MLSD failed for {} ( {} ). Using MDTM".format(remote_dir_name, e)
+        )
+        return get_remote_dir_timestamps_mdtm(ftp_handle, remote_dir_name)
+
+    for entry in entries:
         if (entry[1]["type"] != "file") and (skip_dirs is True):
             pass
         else:
@@ -51,16 +253,66 @@ def get_remote_dir_timestamps(ftp_handle, remote_dir_name, skip_dirs=True):
     return timestamps_dict
 
 
+def get_remote_dir_timestamps_mdtm(ftp_handle, remote_dir_name):
+    """
+    Parse the remote timestamps with one MDTM command per file.
+
+    This is the fallback for servers that do not support MLSD and is much
+    slower, since each file costs a round-trip. MDTM fails for
+    directories, so they are always skipped.
+
+    Return:
+      - timestamps_dict: dict: As in `get_remote_dir_timestamps`
+    """
+    timestamps_dict = {}
+    for name in ftp_handle.nlst(remote_dir_name):
+        fname = posixpath.basename(name)
+        try:
+            resp = ftp_handle.voidcmd(
+                "MDTM {}".format(posixpath.join(remote_dir_name, fname))
+            )
+        except ftplib.error_perm:
+            continue
+        # Response is formatted as '213 YYYYMMDDHHMMSS'
+        timestamps_dict[fname] = {"ftp_mdtm": resp[4:].strip()}
+
+    return timestamps_dict
+
+
+async def get_remote_dir_timestamps_async(
+    client, remote_dir_name, skip_dirs=True
+):
+    """
+    Parse the remote timestamps with an aioftp client.
+
+    Same as `get_remote_dir_timestamps`, with a single MLSD listing
+    """
+    timestamps_dict = {}
+    async for path, info in client.list(remote_dir_name, raw_command="MLSD"):
+        if (info["type"] != "file") and (skip_dirs is True):
+            pass
+        else:
+            timestamps_dict[path.name] = {"ftp_mdtm": info["modify"]}
+
+    return timestamps_dict
+
+
 def get_remote_file_md5(ftp_handle, remote_file_name):
     """Store the md5sum of a file and its contents in memory"""
     _logger.debug(
         "Calculating md5sum for file: {} from remote".format(remote_file_name)
     )
+    md5 = hashlib.md5()
     content = BytesIO()
-    ftp_handle.retrbinary(f"RETR {remote_file_name}", content.write)
-    content_string = content.getvalue()
-    md5 = hashlib.md5(content_string).hexdigest()
-    return md5, content_string
+
+    def consume(block):
+        md5.update(block)
+        content.write(block)
+
+    ftp_handle.retrbinary(
+        f"RETR {remote_file_name}", consume, blocksize=1 << 20
+    )
+    return md5.hexdigest(), content.getvalue()
 
 
 def get_local_info(a_dir):
@@ -68,10 +320,9 @@ def get_local_info(a_dir):
     dir_info = None
     info_tsv = a_dir / pathlib.Path("ftp_info.tsv")
     if info_tsv.exists():
-        dir_info = pd.read_csv(
-            info_tsv, sep="\t", dtype={"ftp_mdtm": "string"}, index_col="fname"
-        )
-        dir_info = dir_info.to_dict(orient="index")
+        with open(info_tsv, "r", newline="") as fin:
+            reader = csv.DictReader(fin, delimiter="\t")
+            dir_info = {row.pop("fname"): row for row in reader}
     else:
         _logger.debug(
             "No mod time information found for {}".format(a_dir.resolve())
@@ -79,6 +330,25 @@ def get_local_info(a_dir):
     return dir_info
 
 
+def write_ftp_info(info_tsv, remote_info):
+    """Write the remote timestamps of a dir to its ftp_info.tsv
+
+    Positional arguments:
+      - info_tsv: pathlib.Path: The file to write
+      - remote_info: dict: As returned by `get_remote_dir_timestamps`
+    """
+    fields = ["ftp_mdtm"]
+    if remote_info:
+        fields = list(next(iter(remote_info.values())).keys())
+    with open(info_tsv, "w", newline="") as fout:
+        writer = csv.writer(fout, delimiter="\t", lineterminator="\n")
+        writer.writerow(["fname"] + fields)
+        writer.writerows(
+            [fname] + [info[k] for k in fields]
+            for fname, info in remote_info.items()
+        )
+
+
 def get_missing_files(a_dir, files_list):
     """Given a list of filenames, scan the dir for their existence"""
     missing_files = []
@@ -102,16 +372,27 @@ def get_missing_files(a_dir, files_list):
 
 
 def md5(fp):
-    """Calculate md5sum for a file"""
-    content = fp.read_text().encode()
-    return hashlib.md5(content).hexdigest()
+    """Calculate md5sum for a file, reading it in 1MB blocks"""
+    md5 = hashlib.md5()
+    with open(fp, "rb") as fin:
+        for block in iter(lambda: fin.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
 
 
 def get_dir_md5(a_dir, files_list):
-    md5_data = {}
-    for f in a_dir.iterdir():
-        if f.name in files_list:
-            md5_data[f.name] = {"md5": md5(f)}
+    """Calculate md5sums for the files of a_dir that are in files_list
+
+    Files are hashed in parallel threads, hashlib releases the GIL while
+    hashing large blocks.
+    """
+    targets = [f for f in a_dir.iterdir() if f.name in files_list]
+    if not targets:
+        return {}
+
+    with ThreadPoolExecutor(min(len(targets), os.cpu_count() or 1)) as ex:
+        md5s = ex.map(md5, targets)
+        md5_data = {f.name: {"md5": h} for f, h in zip(targets, md5s)}
     return md5_data
 
 
@@ -144,9 +425,65 @@ def download_single_file(ftp_handle, remote_fn, local_fp):
         ftp_handle.retrbinary("RETR {}".format(remote_fn), fout.write)
 
 
+def download_single_file_https(https_client, remote_fn, local_fp):
+    """
+    Download one file over https.
+
+    Same as `download_single_file`, with an https client from
+    `open_https_client` instead of an ftp connection. The file is streamed
+    to the local_fp in 1MB blocks.
+    """
+    _logger.debug("Downloading {} in {}".format(remote_fn, local_fp))
+    with https_client.stream("GET", "/{}".format(remote_fn)) as response:
+        response.raise_for_status()
+        with open(local_fp, "wb") as fout:
+            for block in response.iter_bytes(1 << 20):
+                fout.write(block)
+
+
+async def download_single_file_async(client, remote_fn, local_fp):
+    """
+    Download one file with an aioftp client.
+
+    Same as `download_single_file`. The file is streamed to the local_fp
+    in 1MB blocks.
+    """
+    _logger.debug("Downloading {} in {}".format(remote_fn, local_fp))
+    async with client.download_stream(remote_fn) as stream:
+        with open(local_fp, "wb") as fout:
+            async for block in stream.iter_by_block(1 << 20):
+                fout.write(block)
+
+
 def load_cached_genomes(processed_txt):
-    with open(processed_txt, "r") as fin:
-        processed_genomes = [line.strip() for line in fin]
+    """Read the genome ids of a processed genomes file, gzipped or not
+
+    A gzipped file that is cut short or broken, e.g. one that older
+    versions appended to and that a killed mirror run left behind, is read
+    up to where it breaks. The genomes that are lost are synced again.
+    A partial last line is skipped.
+    """
+    processed_genomes = []
+    if processed_txt.name.endswith(".gz"):
+        fin = gzip.open(processed_txt, "rt")
+    else:
+        fin = open(processed_txt, "r")
+    with fin:
+        try:
+            for line in fin:
+                # A last line without a newline is an id that a killed
+                # run cut short
+                if not line.endswith("\n"):
+                    break
+                genome_id = line.strip()
+                if genome_id:
+                    processed_genomes.append(genome_id)
+        except (EOFError, zlib.error, gzip.BadGzipFile):
+            _logger.warning(
+                "{} is broken. Using the {} genome ids read".format(
+                    processed_txt, len(processed_genomes)
+                )
+            )
     return processed_genomes
 
 
@@ -194,10 +531,66 @@ def filter_files_on_mdtm(remote_tstamps, local_tstamps=None):
 
 
 def download_genome_targets(ftp_handle, local_dir, targets_list):
-    """Download the list of target filenames to the local dir"""
+    """Download the list of target filenames to the local dir
+
+    ftp_handle can be an ftplib.FTP connection or an FTPPool. With an
+    FTPPool the files are downloaded in parallel over its connections.
+    """
+    genome_id = local_dir.name
+
+    def download(ftp, f):
+        remote_fname = f"genomes/{genome_id}/{f}"
+        local_fpath = local_dir / pathlib.Path(f)
+        download_single_file(ftp, remote_fname, local_fpath)
+
+    if isinstance(ftp_handle, FTPPool):
+        ftp_handle.map(download, targets_list)
+    else:
+        for f in targets_list:
+            download(ftp_handle, f)
+
+
+def download_genome_targets_https(
+    https_client, local_dir, targets_list, workers=1
+):
+    """Download the list of target filenames to the local dir over https
+
+    Files are requested from `workers` threads that share the https_client
+    """
     genome_id = local_dir.name
-    for f in targets_list:
+
+    def download(f):
         remote_fname = f"genomes/{genome_id}/{f}"
-        local_fpath =  local_dir / pathlib.Path(f)
-        download_single_file(ftp_handle, remote_fname, local_fpath)
+        local_fpath = local_dir / pathlib.Path(f)
+        download_single_file_https(https_client, remote_fname, local_fpath)
+
+    if workers <= 1:
+        for f in targets_list:
+            download(f)
+        return
+
+    with ThreadPoolExecutor(workers) as ex:
+        list(ex.map(download, targets_list))
 
+
+async def download_genome_targets_async(ftp_pool, local_dir, targets_list):
+    """Download the list of target filenames to the local dir
+
+    Files are spread over the clients of the AsyncFTPPool, each client
+    downloads its share one file at a time
+    """
+    genome_id = local_dir.name
+
+    async def download(client, files):
+        for f in files:
+            remote_fname = f"genomes/{genome_id}/{f}"
+            local_fpath = local_dir / pathlib.Path(f)
+            await download_single_file_async(client, remote_fname, local_fpath)
+
+    size = len(ftp_pool.clients)
+    await asyncio.gather(
+        *(
+            download(client, targets_list[i::size])
+            for i, client in enumerate(ftp_pool.clients)
+        )
+    )
@@ -6,27 +6,11 @@ References:
 
 import click
 import logging
+import os
 import pathlib
 import sys
 
 from cirtap import __version__
-from cirtap.mirror import (
-    check_release_dir,
-    check_cache_dir,
-    create_genome_jobs,
-)
-from cirtap.mirror import mirror_genomes_dir
-from cirtap.index import contents, all_data, write_index
-from cirtap.collect import supported_suffixes, is_SSU
-from cirtap.collect import (
-    select_genome_ids,
-    generate_file_list,
-    collect_sequences,
-    concatenate_chunk_files,
-)
-from cirtap.best import select_best
-from cirtap.pack import pack_genome_data
-from cirtap.mailer import send_start_mail, send_exit_mail
 
 __author__ = "papanikos"
 __copyright__ = "papanikos"
@@ -34,6 +18,26 @@ __license__ = "MIT"
 
 _logger = logging.getLogger(__name__)
 
+_LEVELS = {
+    name: getattr(logging, name)
+    for name in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+}
+
+# Input paths are checked by click before any subcommand module is imported
+_EXISTING_DIR = click.Path(
+    exists=True, file_okay=False, path_type=pathlib.Path
+)
+_EXISTING_FILE = click.Path(
+    exists=True, dir_okay=False, path_type=pathlib.Path
+)
+
+# Names of the directories and files in a DB_DIR
+_RELEASE_NOTES = pathlib.Path("RELEASE_NOTES")
+_GENOMES = pathlib.Path("genomes")
+_GENOME_SUMMARY = pathlib.Path("genome_summary")
+_GENOME_LINEAGE = pathlib.Path("genome_lineage")
+_CACHE = pathlib.Path(".cache")
+
 
 def setup_logging(loglevel, logfile):
     """Setup basic logging
@@ -41,8 +45,8 @@ def setup_logging(loglevel, logfile):
     Args:
       loglevel: str: minimum loglevel for emitting messages
     """
-    numeric_level = getattr(logging, loglevel.upper(), None)
-    if not isinstance(numeric_level, int):
+    numeric_level = _LEVELS.get(loglevel.upper())
+    if numeric_level is None:
         raise ValueError("Invalid log level: {}".format(loglevel))
 
     hs = [logging.StreamHandler(stream=sys.stderr)]
@@ -52,6 +56,13 @@ def setup_logging(loglevel, logfile):
 
     logformat = "[%(asctime)s - %(levelname)s:%(name)s] %(message)s"
 
+    # Replace the handlers of a previous call, e.g. when commands are
+    # invoked more than once in the same interpreter
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+
     logging.basicConfig(
         level=numeric_level,
         handlers=hs,
@@ -60,6 +71,26 @@ def setup_logging(loglevel, logfile):
     )
 
 
+def missing_entries(a_dir, names):
+    """Get the names that are not found in a_dir, with a single scandir
+
+    Positional arguments:
+      a_dir: pathlib.Path: The directory to look in
+      names: list: pathlib.Path names of the expected entries
+
+    Return:
+      missing: set: The names (str) that are not found. All of them if
+        a_dir is not a directory
+    """
+    expected = {name.name for name in names}
+    try:
+        with os.scandir(a_dir) as it:
+            found = {entry.name for entry in it}
+    except (FileNotFoundError, NotADirectoryError):
+        found = set()
+    return expected - found
+
+
 @click.group(context_settings=dict(help_option_names=["-h", "--help"]))
 @click.version_option(__version__)
 def cli():
@@ -81,7 +112,35 @@ def cli():
     "--jobs",
     default=1,
     show_default=True,
-    help="Number of parallel processes to start for downloading",
+    help="Number of parallel workers to start for downloading",
+)
+@click.option(
+    "--connections",
+    default=1,
+    show_default=True,
+    help="Number of ftp connections each process opens to download the "
+    "files of a genome in parallel",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(["thread", "process", "async"]),
+    default="thread",
+    show_default=True,
+    help="How genomes are downloaded in parallel. `thread` and `process` "
+    "run JOBS threads or processes. `async` runs JOBS non-blocking ftp "
+    "sessions in a single thread, so JOBS can be much higher than the "
+    "number of cores. It requires aioftp, see the `async` extra, and only "
+    "supports the ftp transport",
+)
+@click.option(
+    "--transport",
+    type=click.Choice(["ftp", "https"]),
+    default="ftp",
+    show_default=True,
+    help="How genome files are downloaded. `https` lists the genome "
+    "directories on the ftp and downloads their files over HTTP/2 with "
+    "CONNECTIONS connections per worker. Requires httpx, see the `https` "
+    "extra",
 )
 @click.option(
     "--skip-release-check",
@@ -97,6 +156,15 @@ def cli():
     is_flag=True,
     help="Skip checks for already processed genomes as found in the cache.",
 )
+@click.option(
+    "--compact-cache",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Always fold the processed genomes of this run into a gzipped "
+    "cache without duplicate genome ids. Without it, this is done once the "
+    "cache holds more than twice as many genome ids as unique ones",
+)
 @click.option(
     "--force-check",
     is_flag=True,
@@ -146,6 +214,13 @@ def cli():
     "progress will not be shown and the more descriptive debugging messages "
     "will be printed to stderr instead",
 )
+@click.option(
+    "--debug-sample",
+    type=_EXISTING_FILE,
+    required=False,
+    help="Only sync the genome ids listed in this file, one per line. "
+    "Useful for testing a run on a few genomes",
+)
 @click.option(
     "--logfile",
     help="Write logging information in this file",
@@ -158,20 +233,39 @@ def mirror(
     cache_dir,
     skip_release_check,
     jobs,
+    connections,
+    backend,
+    transport,
     skip_processed_genomes,
     notify,
     archive_notes,
     resume,
+    compact_cache,
     force_check,
     progress,
+    debug_sample,
     logfile,
 ):
     """Mirror all data from ftp.patricbrc.org in the specified DB_DIR"""
 
+    from cirtap.mirror import (
+        check_release_dir,
+        check_cache_dir,
+        create_genome_jobs,
+        compact_processed_genomes,
+        mirror_genomes_dir,
+    )
+    from cirtap.mailer import Mailer
+    from cirtap.mailer import notify_in_background, notify_and_wait
+
     setup_logging(loglevel, logfile)
     _logger.info("Full command: {}".format(" ".join(sys.argv[:])))
     _logger.info("Version: {}".format(__version__))
 
+    recipients = [s.strip() for s in notify.split(",")] if notify else None
+    # All mails of the run go over one SMTP connection
+    mailer = Mailer(recipients) if recipients else None
+
     if progress and (loglevel == "debug"):
         _logger.info(
             "Unsetting `progress` option because it conflicts with "
@@ -179,11 +273,13 @@ def mirror(
         )
         progress = False
 
-    release_notes_dir = db_dir / pathlib.Path("RELEASE_NOTES")
-    genomes_dir = db_dir / pathlib.Path("genomes")
+    # Resolve once, all paths below are derived from it
+    db_dir = db_dir.resolve()
+    release_notes_dir = db_dir / _RELEASE_NOTES
+    genomes_dir = db_dir / _GENOMES
 
     if not db_dir.exists():
-        _logger.info("Fresh mirror in: {}".format(db_dir.resolve()))
+        _logger.info("Fresh mirror in: {}".format(db_dir))
         db_dir.mkdir(parents=True)
         release_notes_dir.mkdir()
         genomes_dir.mkdir()
@@ -191,7 +287,7 @@ def mirror(
     # Load already processed genomes from cache if found
     # Otherwise processed_genomes is an empty set
     if not cache_dir:
-        cache_dir = db_dir / pathlib.Path(".cache")
+        cache_dir = db_dir / _CACHE
     processed_genomes = check_cache_dir(cache_dir)
 
     check_genomes = True
@@ -201,87 +297,80 @@ def mirror(
             release_notes_dir, archive=archive_notes
         )
 
-    genome_summary = release_notes_dir / pathlib.Path("genome_summary")
-
-    # Create a list of jobs that can be multiprocessed
-    genome_jobs = create_genome_jobs(
-        genome_summary, genomes_dir, processed_genomes
-    )
+    genome_summary = release_notes_dir / _GENOME_SUMMARY
 
     # Do not check already existing genome_ids retrieved from the cache
     # These will not be submitted in the main mirror step
     # Speeds up re-executions if things failed the first time
     # Assumes that an update has not occured in between
-    if skip_processed_genomes or resume:
-        genome_jobs = [
-            job for job in genome_jobs if job not in processed_genomes
-        ]
+    skip = skip_processed_genomes or resume
+
+    sample = None
+    if debug_sample:
+        with open(debug_sample, "r") as fin:
+            sample = frozenset(line.strip() for line in fin if line.strip())
+
+    # Create a list of jobs that can be multiprocessed
+    genome_jobs = list(
+        create_genome_jobs(
+            genome_summary,
+            genomes_dir,
+            processed_genomes,
+            skip=skip,
+            only=sample,
+        )
+    )
+    _logger.debug("Continuing with {} genomes".format(len(genome_jobs)))
 
     # Try to notify but don't try too hard
-    if notify:
-        recipients = [str(i).strip() for i in notify.split(",")]
-        try:
-            send_start_mail(
-                recipients,
-                db_dir,
-                len(genome_jobs),
-            )
-        except:
-            _logger.debug("Failed to send email")
-
-#     Testing
-#    ten_targets = [
-#        "100053.5",
-#        "1006155.5", # Missing
-#        "2030827.47", # Permission denied 
-#        "100.9",
-#        "1123738.3",
-#        "1000562.3",
-#        "100053.8",
-#        "469009.4",
-#        "1309411.5",
-#        "100053.6",
-#     ]
-#    genome_jobs = [job for job in genome_jobs if job in ten_targets]
+    if mailer:
+        notify_in_background(mailer.send_start, db_dir, len(genome_jobs))
 
     try:
         if (
             len(genome_jobs) != 0 and check_genomes is True
         ) or force_check is True:
             finished_jobs = mirror_genomes_dir(
-                genome_jobs, genomes_dir, cache_dir, jobs, progress_bar=progress
-            )
-            new_genomes_processed = processed_genomes.union(set(finished_jobs))
-            processed_genomes_txt = cache_dir / pathlib.Path(
-                "processed_genomes.txt"
+                genome_jobs,
+                genomes_dir,
+                cache_dir,
+                jobs,
+                progress_bar=progress,
+                connections=connections,
+                backend=backend,
+                transport=transport,
             )
-            # Re-write the file with all new and old ids
-            with open(processed_genomes_txt, "w") as fout:
-                for genome_id in new_genomes_processed:
-                    fout.write(f"{genome_id}\n")
+            # Nothing new was appended to the cache if nothing finished
+            if finished_jobs:
+                # processed_genomes is not used after this, so it is
+                # updated in place instead of copied
+                processed_genomes.update(finished_jobs)
+                compact_processed_genomes(
+                    cache_dir, processed_genomes, force=compact_cache
+                )
         else:
             _logger.info(
                 "All genomes for this version of RELEASE_NOTES seem "
                 "to have been properly processed"
             )
     except Exception as e:
-        if notify:
-            recipients = [str(i).strip() for i in notify.split(",")]
-            send_exit_mail(recipients, str(e))
+        if mailer:
+            notify_and_wait(mailer.send_exit, str(e))
+            mailer.close()
 
         _logger.critical("Mirror job failed with \n{}".format(e))
         raise
 
-    if notify:
-        recipients = [str(i).strip() for i in notify.split(",")]
-        send_exit_mail(recipients)
+    if mailer:
+        notify_and_wait(mailer.send_exit)
+        mailer.close()
 
 
 @click.command()
 @click.argument(
     "genomes-dir",
     required=True,
-    type=pathlib.Path,
+    type=_EXISTING_DIR,
 )
 @click.argument(
     "output-index",
@@ -309,30 +398,45 @@ def mirror(
     help="Number of parallel reads to execute. Speeds things up when "
     "iterating over all the data dirs",
 )
-def index(genomes_dir, output_index, loglevel, logfile, jobs):
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["tsv", "parquet"]),
+    default="tsv",
+    show_default=True,
+    help="Format of the OUTPUT_INDEX. A parquet index is written with a "
+    ".parquet suffix and requires pyarrow, see the `arrow` extra",
+)
+def index(genomes_dir, output_index, loglevel, logfile, jobs, output_format):
     """Create an index of contents for all directories
 
     This can be useful for generating valid paths before gathering inputs.
-    The output_index is a tab-separated file with each column representing
-    the files that are expected to be found for a genome that has full
-    information available from both PATRIC and RefSeq. If any of the files
-    is missing the value is 0.
+    The output_index is a tab-separated (or parquet) file with each column
+    representing the files that are expected to be found for a genome that
+    has full information available from both PATRIC and RefSeq. If any of
+    the files is missing the value is 0.
 
     genomes_dir: The location where all data is stored
 
     output_index:  The files to write all the info in
 
     """
+    from cirtap.index import contents, all_data, write_index
+    from cirtap.index import require_pyarrow
+
     setup_logging(loglevel, logfile)
+    # Fail before any genome directory is read
+    if output_format == "parquet":
+        require_pyarrow()
     all_records = all_data(genomes_dir, contents, jobs)
-    write_index(all_records, output_index)
+    write_index(all_records, output_index, output_format)
     return
 
 
 @click.command()
-@click.argument("genomes-dir", required=True, type=pathlib.Path)
+@click.argument("genomes-dir", required=True, type=_EXISTING_DIR)
 @click.argument("output-path", required=True, type=pathlib.Path)
-@click.option("-i", "--index-path", required=True, type=pathlib.Path)
+@click.option("-i", "--index-path", required=True, type=_EXISTING_FILE)
 @click.option(
     "-t",
     "--target-set",
@@ -386,6 +490,17 @@ def collect(
     Due to the way things are implemented any jobs number you
     supply will be multiplied by 4.
     """
+    from cirtap.collect import (
+        supported_suffixes,
+        is_gz,
+        is_SSU,
+        select_genome_ids,
+        generate_file_list,
+        CountingIterator,
+        collect_sequences,
+        concatenate_chunk_files,
+    )
+
     setup_logging(loglevel, logfile)
 
     filters = []
@@ -401,20 +516,25 @@ def collect(
     _logger.info("Reading index information")
     genome_ids = select_genome_ids(index_path, target)
 
-    _logger.info("Generating files list")
-    files_list = generate_file_list(
-        genomes_dir, genome_ids, target, supported_suffixes
-    )
-    _logger.info(
-        "Sequences will be collected from {} files".format(len(files_list))
+    files_list = CountingIterator(
+        generate_file_list(genomes_dir, genome_ids, target, supported_suffixes)
     )
 
     tmp_dir = output_path.parent / pathlib.Path("tmp")
     tmp_dir.mkdir(exist_ok=True)
 
-    collect_sequences(files_list, tmp_dir, *filters, nthreads=jobs)
+    seqs_no = collect_sequences(
+        files_list,
+        tmp_dir,
+        *filters,
+        nthreads=jobs,
+        compressed_output=is_gz(output_path),
+    )
+    _logger.info(
+        "Sequences were collected from {} files".format(files_list.count)
+    )
 
-    files_no, seqs_no = concatenate_chunk_files(tmp_dir, output_path, cleanup)
+    files_no = concatenate_chunk_files(tmp_dir, output_path, cleanup)
     _logger.info(
         "Collected {} sequences from {} files".format(seqs_no, files_no)
     )
@@ -428,14 +548,14 @@ def collect(
 @click.option(
     "-i",
     "--index-path",
-    type=pathlib.Path,
+    type=_EXISTING_FILE,
     required=True,
     help="Path to the index file",
 )
 @click.option(
     "-d",
     "--db-dir",
-    type=pathlib.Path,
+    type=_EXISTING_DIR,
     required=True,
     help="Path to the local mirror. Must contain a `RELEASE_NOTES` directory "
     "and a `genomes` directory",
@@ -476,16 +596,22 @@ def best(db_dir, index_path, output_path, thresh, ncbi_db, loglevel, logfile):
     Results are written in the provided output_path and include tables
     containing genome ids with their stats and lineages attached
     """
+    from cirtap.best import select_best
+    from cirtap.collect import select_genome_ids
+
     setup_logging(loglevel, logfile)
 
-    genomes_dir = db_dir / pathlib.Path("genomes")
-    notes_dir = db_dir / pathlib.Path("RELEASE_NOTES")
-    genome_summary = notes_dir / pathlib.Path("genome_summary")
-    genome_lineage = notes_dir / pathlib.Path("genome_lineage")
-    if not all(
-        p.resolve().exists()
-        for p in [notes_dir, genome_summary, genome_lineage, genomes_dir]
-    ):
+    genomes_dir = db_dir / _GENOMES
+    notes_dir = db_dir / _RELEASE_NOTES
+    genome_summary = notes_dir / _GENOME_SUMMARY
+    genome_lineage = notes_dir / _GENOME_LINEAGE
+    # One directory read per level instead of a stat per path
+    missing = missing_entries(db_dir, [_RELEASE_NOTES, _GENOMES])
+    if not missing:
+        missing = missing_entries(
+            notes_dir, [_GENOME_SUMMARY, _GENOME_LINEAGE]
+        )
+    if missing:
         _logger.error("Please provide a valid db path. ")
         _logger.error(
             "This must contain "
@@ -515,14 +641,14 @@ def best(db_dir, index_path, output_path, thresh, ncbi_db, loglevel, logfile):
 @click.option(
     "-g",
     "--genomes-dir",
-    type=pathlib.Path,
+    type=_EXISTING_DIR,
     required=True,
     help="Path to the genomes directory containing all data",
 )
 @click.option(
     "-i",
     "--input-list",
-    type=pathlib.Path,
+    type=_EXISTING_FILE,
     help="Single column file containing one genome id per line",
     required=True,
 )
@@ -534,6 +660,21 @@ def best(db_dir, index_path, output_path, thresh, ncbi_db, loglevel, logfile):
     "supported",
     required=True,
 )
+@click.option(
+    "-j",
+    "--jobs",
+    default=0,
+    show_default=True,
+    type=int,
+    help="Number of compression threads, 0 uses all cores. Only used if "
+    "pigz is available",
+)
+@click.option(
+    "--dedup",
+    is_flag=True,
+    help="Store small files that are identical to one already in the "
+    "archive as hard links to it. Extracted copies share their contents",
+)
 @click.option(
     "--loglevel",
     default="INFO",
@@ -547,14 +688,16 @@ def best(db_dir, index_path, output_path, thresh, ncbi_db, loglevel, logfile):
     show_default=True,
     required=False,
 )
-def pack(genomes_dir, input_list, output, loglevel, logfile):
+def pack(genomes_dir, input_list, output, jobs, dedup, loglevel, logfile):
     """Create a gzipped tar archive from a list of genome ids in a file
 
     For now the output specified is a tar.gz file, even if you don't name it
-    as such.
+    as such. Compression is done by pigz when it is on the PATH.
     """
+    from cirtap.pack import pack_genome_data
+
     setup_logging(loglevel, logfile)
-    pack_genome_data(genomes_dir, input_list, output)
+    pack_genome_data(genomes_dir, input_list, output, jobs, dedup)
 
 
 cli.add_command(mirror)
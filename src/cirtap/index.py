@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+import importlib.util
 import logging
-import pathlib
+import numpy as np
+import os
 import pandas as pd
-import multiprocessing as mp
 
 _logger = logging.getLogger(__name__)
 
+# Number of records that are held as dicts at any time
+INDEX_BATCH = 10000
+
 ## A "complete" dir listing
 # 511145.12.fna
 # 511145.12.PATRIC.faa
@@ -53,6 +60,19 @@ contents = {
     },
 }
 
+# Column name for each (database, file suffix) pair, e.g.
+# ("RefSeq", "faa") -> "refseq_proteins"
+LOOKUP = {
+    (db, suffix): col_name
+    for db in ("PATRIC", "RefSeq")
+    for suffix, col_name in contents[db].items()
+}
+
+# Every column set to absent. genome_data starts from a copy of this
+DEFAULT_ZEROS = {
+    col_name: 0 for d in contents.values() for col_name in d.values()
+}
+
 
 # def construct_filename(genome_id, db, f):
 #    db_suffix = contents["db"][db]["name"]
@@ -60,76 +80,122 @@ contents = {
 #    return f"{genome_id}.{db_suffix}.{file_suffix}"
 
 
-def genome_data(genome_dir, contents):
-    """Create a dict of presence (1) | absence (0) of files in a dir"""
-    genome_id = genome_dir.name
-    genome_data = {"genome_id": genome_id}
-
-    # Required for cases like 7227.4 where an ht2.tar was there
-    valid_suffixes = []
-    for d in contents.keys():
-        for dk in contents[d].keys():
-            if dk not in valid_suffixes:
-                valid_suffixes.append(dk)
+def genome_data(genome_dir, contents=contents):
+    """Create a dict of presence (1) | absence (0) of files in a dir
 
-    _logger.debug("Processing dir: {}".format(genome_dir))
-    for f in genome_dir.iterdir():
-        fname = f.name
-        fname_fields = fname.split(".")
+    Files are matched against the module level LOOKUP, built from
+    `contents`. Anything not in there is skipped, e.g. the ht2.tar found
+    in 7227.4. The contents argument is kept for compatibility
 
-        if fname == "ftp_info.tsv":
-            continue
+    genome_dir can be a str or a pathlib.Path
+    """
+    genome_dir = os.fspath(genome_dir)
+    genome_data = DEFAULT_ZEROS.copy()
+    genome_data["genome_id"] = os.path.basename(genome_dir)
 
-        if fname_fields[-1] == "fna":
-            col_name = contents["genome"]["fna"]
-            genome_data["patric_genome"] = 1
-        else:
-            db = fname_fields[2]
-            suffix = ".".join(fname_fields[3:])
-            if suffix in valid_suffixes:
-                if db == "RefSeq":
-                    col_name = contents["RefSeq"][suffix]
-                else:
-                    col_name = contents["PATRIC"][suffix]
-
-                genome_data[col_name] = 1
-
-    # TO DO
-    # Change the contents dic to something more sane
-    ## For the files that were not found
-    for d in contents.keys():
-        for v in contents[d].values():
-            if v not in genome_data:
-                genome_data[v] = 0
+    _logger.debug("Processing dir: {}".format(genome_dir))
+    with os.scandir(genome_dir) as it:
+        for entry in it:
+            fname_fields = entry.name.split(".")
+
+            if fname_fields[-1] == "fna":
+                genome_data["patric_genome"] = 1
+            else:
+                # ftp_info.tsv and other short names have no db field
+                db = fname_fields[2] if len(fname_fields) > 3 else None
+                col_name = LOOKUP.get((db, ".".join(fname_fields[3:])))
+                if col_name is not None:
+                    genome_data[col_name] = 1
 
     return genome_data
 
 
-def all_data(genomes_dir, contents_dic, jobs=1):
-    """Parallelizable read of all directories in a list of dicts"""
-    all_records = []
-    _logger.info("Loading directories")
-    dir_jobs = [(g, contents_dic) for g in genomes_dir.iterdir()]
-    _logger.info("Reading information")
-    with mp.Pool(processes=jobs) as pool:
-        all_records = pool.starmap(genome_data, dir_jobs)
+def genome_dirs(genomes_dir):
+    """Yield the paths of the directories in genomes_dir as plain strings
 
-    return all_records
+    os.scandir gets the file type along with the name, so no extra stat
+    is needed per entry
+    """
+    with os.scandir(genomes_dir) as it:
+        for entry in it:
+            if entry.is_dir():
+                yield entry.path
 
 
-def write_index(records_list, output_index):
-    """Create and write a pandas df to the specified file"""
-    # Grab the first record dict
-    some_record = records_list[0]
-    # Map all values to integers
-    dtypes = {k: "int64" for k in some_record.keys()}
-    # Except for genome id that needs to be a string
-    dtypes["genome_id"] = "string"
-    index_df = pd.DataFrame.from_records(records_list)
-    index_df = index_df.astype(dtypes)
+def all_data(genomes_dir, contents_dic, jobs=1):
+    """Read all directories in `jobs` threads and yield their records
+
+    Reading a directory is bound by the filesystem rather than the cpu,
+    so threads scale well, especially on network filesystems.
+    """
+    _logger.info("Reading information")
+    read_dir = partial(genome_data, contents=contents_dic)
+    dirs = genome_dirs(genomes_dir)
+    with ThreadPoolExecutor(max_workers=jobs) as ex:
+        # Executor.map submits everything it is given up front, so feed
+        # it one batch at a time to keep the pending results bounded
+        while True:
+            batch = list(islice(dirs, INDEX_BATCH))
+            if not batch:
+                break
+            yield from ex.map(read_dir, batch)
+
+
+def records_to_df(records):
+    """Convert a list of genome_data records to a dataframe
+
+    Each column is built with its final type, so the frame is not copied
+    by a later astype. All values are 0/1 presence flags stored in a
+    byte each, except for genome id that needs to be a string
+    """
+    n = len(records)
+    cols = {}
+    for k in records[0].keys():
+        if k == "genome_id":
+            cols[k] = pd.array([r[k] for r in records], dtype="string")
+        else:
+            cols[k] = np.fromiter(
+                (r[k] for r in records), dtype=np.uint8, count=n
+            )
+    return pd.DataFrame(cols, copy=False)
+
+
+def require_pyarrow():
+    """Raise an ImportError if pyarrow, needed for parquet, is not installed
+
+    pyarrow is only looked up, so this is cheap to call before any work
+    """
+    if importlib.util.find_spec("pyarrow") is None:
+        raise ImportError(
+            "The parquet format requires pyarrow. "
+            "Install it with `pip install cirtap[arrow]`"
+        )
+
+
+def write_index(records_list, output_index, output_format="tsv"):
+    """Create and write a pandas df to the specified file
+
+    records_list can be any iterable of records, e.g. the all_data
+    generator. It is consumed INDEX_BATCH records at a time, so only the
+    compact columns are kept for the whole index
+
+    With the `parquet` output_format the index is written as a zstd
+    compressed parquet file with a .parquet suffix. This requires pyarrow.
+
+    Return:
+      output_index: pathlib.Path: The file written
+    """
+    records = iter(records_list)
+    frames = []
+    while True:
+        batch = list(islice(records, INDEX_BATCH))
+        if not batch:
+            break
+        frames.append(records_to_df(batch))
+    index_df = pd.concat(frames, ignore_index=True)
 
     # Show missing genomes first
-    index_df = index_df.sort_values(by="patric_genome")
+    index_df = index_df.sort_values(by="patric_genome", kind="stable")
 
     # Reorder the columns so that genome id and genome show first
     cols_reordered = ["genome_id", "patric_genome"]
@@ -139,4 +205,13 @@ def write_index(records_list, output_index):
     index_df = index_df[cols_reordered]
 
     # Write it
-    index_df.to_csv(output_index, sep="\t", index=False)
+    if output_format == "parquet":
+        output_index = output_index.with_suffix(".parquet")
+        index_df.to_parquet(
+            output_index, engine="pyarrow", compression="zstd", index=False
+        )
+    else:
+        index_df.to_csv(output_index, sep="\t", index=False)
+
+    _logger.info("Index written in {}".format(output_index))
+    return output_index
@@ -1,55 +1,149 @@
+import logging
 import smtplib
+import threading
 from email.message import EmailMessage
 
 CIRTAP_MAILER = "cirtap@mydomain.com"
 
+_logger = logging.getLogger(__name__)
+
+
+class Mailer:
+    """
+    Send the cirtap notification mails over a single SMTP connection.
+
+    The connection is opened with the first mail and kept for the next
+    ones. A mirror run can take hours, so a connection that the server
+    dropped in the meantime is opened again. Mails can be sent from
+    background threads, one at a time.
+
+    Positional arguments:
+      - recipients: list: Email addresses to notify
+
+    Keyword arguments:
+      - host: str: The SMTP server to send mails through
+    """
+
+    def __init__(self, recipients, host="localhost"):
+        self.recipients = list(recipients)
+        self.host = host
+        self._smtp = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.noop()
+            except smtplib.SMTPServerDisconnected:
+                self._smtp = None
+        if self._smtp is None:
+            self._smtp = smtplib.SMTP(self.host, timeout=30)
+            self._smtp.ehlo()
+        return self._smtp
+
+    def _send(self, content):
+        msg = EmailMessage()
+
+        msg["Subject"] = "[CIRTAP-BOT] PATRIC update"
+        msg["From"] = CIRTAP_MAILER
+        msg["To"] = self.recipients
+
+        msg.set_content(content)
+
+        with self._lock:
+            self._connection().send_message(
+                msg, from_addr=CIRTAP_MAILER, to_addrs=self.recipients
+            )
+
+    def send_start(self, db_dir, no_of_genomes):
+        """db_dir is shown as given, pass it resolved"""
+        start_content = (
+            "A mirror job for PATRIC was launched by cirtap.\n"
+            "Details:\n"
+            "\n"
+            "Local dir: {}\n"
+            "No. of genomes: {}\n"
+            "\n"
+            "You may receive another email once the run finishes "
+            "successfully or fails\n"
+        ).format(db_dir, no_of_genomes)
+        self._send(start_content)
+
+    def send_exit(self, error_msg=None):
+        if error_msg:
+            msg_pre = "Cirtap failed!"
+            error_content = "Error was : {}".format(error_msg)
+
+        else:
+            msg_pre = "Cirtap succeeded!"
+            error_content = ""
+
+        self._send("\n".join([msg_pre, error_content]))
+
+    def close(self):
+        """Quit the SMTP connection, unless a mail is still being sent
+
+        A mail that is stuck is left to its daemon thread
+        """
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self._smtp is not None:
+                try:
+                    self._smtp.quit()
+                except smtplib.SMTPException:
+                    self._smtp.close()
+                self._smtp = None
+        finally:
+            self._lock.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 
 def send_start_mail(
     recipients,
     db_dir,
     no_of_genomes,
 ):
-    msg = EmailMessage()
+    with Mailer(recipients) as mailer:
+        mailer.send_start(db_dir.resolve(), no_of_genomes)
 
-    msg["Subject"] = "[CIRTAP-BOT] PATRIC update"
-    msg["From"] = CIRTAP_MAILER
-    msg["To"] = recipients
 
-    start_content = (
-        "A mirror job for PATRIC was launched by cirtap.\n"
-        "Details:\n"
-        "\n"
-        "Local dir: {}\n"
-        "No. of genomes: {}\n"
-        "\n"
-        "You may receive another email once the run finishes successfully or "
-        "fails\n"
-    ).format(db_dir.resolve(), no_of_genomes)
+def send_exit_mail(recipients, error_msg=None):
+    with Mailer(recipients) as mailer:
+        mailer.send_exit(error_msg)
 
-    msg.set_content(start_content)
 
-    s = smtplib.SMTP("localhost")
-    s.sendmail(CIRTAP_MAILER, recipients, msg.as_string())
-    s.quit()
+def notify_in_background(send_func, *args):
+    """Call one of the send_* mail functions in a daemon thread
 
+    Failures are logged and never raised, so mails do not get in the way
+    of the run.
 
-def send_exit_mail(recipients, error_msg=None):
-    msg = EmailMessage()
+    Return:
+      thread: threading.Thread: The started thread
+    """
 
-    msg["Subject"] = "[CIRTAP-BOT] PATRIC update"
-    msg["From"] = CIRTAP_MAILER
-    msg["To"] = recipients
+    def send():
+        try:
+            send_func(*args)
+        except Exception as e:
+            _logger.debug("Failed to send email ( {} )".format(e))
 
-    if error_msg:
-        msg_pre = "Cirtap failed!"
-        error_content = "Error was : {}".format(error_msg)
+    thread = threading.Thread(target=send, daemon=True)
+    thread.start()
+    return thread
 
-    else:
-        msg_pre = "Cirtap succeeded!"
-        error_content = ""
 
-    message_txt = "\n".join([msg_pre, error_content])
-    msg.set_content(message_txt)
-    s = smtplib.SMTP("localhost")
-    s.sendmail(CIRTAP_MAILER, recipients, msg.as_string())
-    s.quit()
+def notify_and_wait(send_func, *args, timeout=5):
+    """Like notify_in_background, but wait up to timeout seconds for it"""
+    thread = notify_in_background(send_func, *args)
+    thread.join(timeout)
+    if thread.is_alive():
+        _logger.warning(
+            "Email was not sent within {} seconds. Giving up".format(timeout)
+        )
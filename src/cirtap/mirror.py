@@ -1,21 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
 from functools import partial
+from itertools import islice
+import asyncio
 import ftplib
+import gzip
 import logging
 import multiprocessing as mp
-import pandas as pd
 import pathlib
 import shutil
+import threading
 import time
 from tqdm import tqdm
 
-from .common import PATRIC_FTP, RELEASE_NOTES_FILES
+from .common import PATRIC_FTP, RELEASE_NOTES_FILES, FTPPool
 from .common import get_missing_files, get_dir_md5, get_remote_dir_timestamps
 from .common import load_cached_genomes, genomes_from_summary
-from .common import get_local_info, get_remote_file_md5
+from .common import get_local_info, write_ftp_info, get_remote_file_md5
 from .common import filter_files_on_mdtm, download_genome_targets
+from .common import open_https_client, download_genome_targets_https
+from .common import require_httpx, require_aioftp, AsyncFTPPool
+from .common import get_remote_dir_timestamps_async
+from .common import download_genome_targets_async, is_missing_genome_error
 
 _logger = logging.getLogger(__name__)
 
+# Genome ids are appended to this plain text log of the cache dir as they
+# are synced. A killed run loses at most the id it was writing
+PROCESSED_TXT = pathlib.Path("processed_genomes.txt")
+# Compacting folds the log into this gzipped file, see
+# compact_processed_genomes
+PROCESSED_TXT_GZ = pathlib.Path("processed_genomes.txt.gz")
+
+# Genome jobs are handed to the thread backend in windows of
+# this size, so memory does not grow with the number of genomes
+MIRROR_BATCH = 1000
+
+# Upper limit for the chunks of genome jobs sent to each mirror process
+PROCESS_CHUNK_MAX = 32
+
 
 def set_remote_version_on_summary():
     """Use the year and month in YYYYMM format as a version"""
@@ -56,7 +79,7 @@ def archive_notes(release_dir, version_suffix=None):
     else:
         basename = "REELASE_NOTES.bkp"
     archive_name = db_dir / pathlib.Path(basename)
-    root_dir = db_dir.resolve()
+    root_dir = db_dir
     base_dir = "RELEASE_NOTES"
 
     shutil.make_archive(
@@ -90,51 +113,93 @@ def check_release_dir(release_dir, archive=True):
 
     local_md5s = get_dir_md5(release_dir, RELEASE_NOTES_FILES)
 
-    check_genomes = False
-    with ftplib.FTP(PATRIC_FTP) as ftp:
-        ftp.login()
-
-        for f in RELEASE_NOTES_FILES:
-            remote_name = f"RELEASE_NOTES/{f}"
-            remote_md5, contents = get_remote_file_md5(ftp, remote_name)
-            local_fp = release_dir / pathlib.Path(f)
-            if f in present_files:
-                if remote_md5 != local_md5s[f]["md5"]:
-                    _logger.info("Updating file: {}".format(f))
-                    local_fp.write_bytes(contents)
-                    check_genomes = True
-                else:
-                    _logger.info("File: {} is up to date".format(f))
+    # Fetch all files at once, each over its own connection
+    notes_files = sorted(RELEASE_NOTES_FILES)
+    with FTPPool(PATRIC_FTP, size=len(notes_files)) as ftp_pool:
+        remote_files = ftp_pool.map(
+            lambda ftp, f: get_remote_file_md5(ftp, f"RELEASE_NOTES/{f}"),
+            notes_files,
+        )
 
-            elif f in missing_files:
-                _logger.info("Fetching file: {}".format(f))
+    # Files are written here, one at a time
+    check_genomes = False
+    for f, (remote_md5, contents) in zip(notes_files, remote_files):
+        local_fp = release_dir / pathlib.Path(f)
+        if f in present_files:
+            if remote_md5 != local_md5s[f]["md5"]:
+                _logger.info("Updating file: {}".format(f))
                 local_fp.write_bytes(contents)
                 check_genomes = True
-
             else:
-                _logger.critical("WHAT HAPPENED with {}?".format(f))
-                raise
+                _logger.info("File: {} is up to date".format(f))
+
+        elif f in missing_files:
+            _logger.info("Fetching file: {}".format(f))
+            local_fp.write_bytes(contents)
+            check_genomes = True
+
+        else:
+            _logger.critical("WHAT HAPPENED with {}?".format(f))
+            raise
 
     return check_genomes
 
 
 def check_cache_dir(cache_dir):
-    processed_genomes = []
+    processed_genomes = set()
     if not cache_dir.exists():
         _logger.debug("No cache found. Creating it at {}".format(cache_dir))
         cache_dir.mkdir()
-        processed_txt = cache_dir / pathlib.Path("processed_genomes.txt")
     else:
-        try:
-            processed_txt = cache_dir / pathlib.Path("processed_genomes.txt")
-            processed_genomes = load_cached_genomes(processed_txt)
-        except FileNotFoundError:
-            _logger.debug(
-                "No processed_genomes.txt found in {}".format(
-                    cache_dir.resolve()
+        for processed_txt in (PROCESSED_TXT_GZ, PROCESSED_TXT):
+            try:
+                processed_genomes.update(
+                    load_cached_genomes(cache_dir / processed_txt)
+                )
+            except FileNotFoundError:
+                _logger.debug(
+                    "No {} found in {}".format(
+                        processed_txt, cache_dir.resolve()
+                    )
                 )
+    return processed_genomes
+
+
+def drop_partial_line(processed_txt):
+    """Truncate the log after its last newline
+
+    A killed run can leave a genome id cut short, e.g. 1234.1 for
+    1234.12, which might be another genome id. It is dropped, so that
+    genome is synced again
+    """
+    with open(processed_txt, "r+b") as f:
+        end = f.seek(0, 2)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - (1 << 16))
+            f.seek(start)
+            block = f.read(pos - start)
+            last_newline = block.rfind(b"\n")
+            if last_newline != -1:
+                pos = start + last_newline + 1
+                break
+            pos = start
+        if pos != end:
+            _logger.warning(
+                "Dropping a partial genome id from {}".format(processed_txt)
             )
-    return set(processed_genomes)
+            f.truncate(pos)
+
+
+def open_processed_genomes(cache_dir):
+    """Open the processed genomes log for appending genome ids
+
+    A partial last line that a killed run left is dropped first
+    """
+    processed_txt = cache_dir / PROCESSED_TXT
+    if processed_txt.exists():
+        drop_partial_line(processed_txt)
+    return open(processed_txt, "a")
 
 
 # @tenacity.retry(
@@ -143,8 +208,79 @@ def check_cache_dir(cache_dir):
 #    wait=tenacity.wait.wait_exponential(multiplier=1, min=10, max=60),
 #    stop=tenacity.stop.stop_after_attempt(3),
 # )
-def sync_single_dir(genomes_dir, genome_id, attempts=3, write_info=True):
-    """Download/update all info for the genome id"""
+# The FTPPool and https client each worker thread (or process) keeps
+# between genomes
+_worker = threading.local()
+# All the worker connections that are open, so they can be closed once
+# the threads that own them are done
+_worker_connections = set()
+_worker_connections_lock = threading.Lock()
+
+
+def _track_worker_connection(conn):
+    with _worker_connections_lock:
+        _worker_connections.add(conn)
+    return conn
+
+
+def get_worker_ftp_pool(connections=1):
+    """Get the FTPPool of this worker, logging in on the first call"""
+    ftp_pool = getattr(_worker, "ftp_pool", None)
+    if ftp_pool is None:
+        ftp_pool = FTPPool(PATRIC_FTP, size=connections)
+        _worker.ftp_pool = _track_worker_connection(ftp_pool)
+    return ftp_pool
+
+
+def get_worker_https_client(connections=1):
+    """Get the https client of this worker, opening it on the first call"""
+    https_client = getattr(_worker, "https_client", None)
+    if https_client is None:
+        https_client = open_https_client(size=connections)
+        _worker.https_client = _track_worker_connection(https_client)
+    return https_client
+
+
+def reset_worker_connections():
+    """Close the connections of this worker, the next genome opens new ones"""
+    for attr in ("ftp_pool", "https_client"):
+        conn = getattr(_worker, attr, None)
+        if conn is not None:
+            setattr(_worker, attr, None)
+            with _worker_connections_lock:
+                _worker_connections.discard(conn)
+            conn.close()
+
+
+def close_worker_connections():
+    """Close the connections of all workers of this process"""
+    with _worker_connections_lock:
+        conns = list(_worker_connections)
+        _worker_connections.clear()
+    for conn in conns:
+        conn.close()
+
+
+def sync_single_dir(
+    genomes_dir,
+    genome_id,
+    attempts=3,
+    write_info=True,
+    connections=1,
+    reuse_connections=False,
+    transport="ftp",
+):
+    """Download/update all info for the genome id
+
+    The files of the genome are downloaded over `connections` parallel
+    ftp connections. With the `https` transport the remote dir is still
+    listed over a single ftp connection and the files are downloaded with
+    an https client of `connections` connections instead. With
+    reuse_connections, the connections of the worker are kept open for
+    the next genomes and only opened again after a failed attempt.
+    """
+    use_https = transport == "https"
+    ftp_connections = 1 if use_https else connections
 
     remote_dirname = f"genomes/{genome_id}"
 
@@ -158,9 +294,24 @@ def sync_single_dir(genomes_dir, genome_id, attempts=3, write_info=True):
     # So no genome id will be there
     for attempt in range(1, attempts + 1):
         try:
-            with ftplib.FTP(PATRIC_FTP) as ftp:
-                ftp.login()
-                remote_info = get_remote_dir_timestamps(ftp, remote_dirname)
+            https_context = nullcontext()
+            if reuse_connections:
+                pool_context = nullcontext(
+                    get_worker_ftp_pool(ftp_connections)
+                )
+                if use_https:
+                    https_context = nullcontext(
+                        get_worker_https_client(connections)
+                    )
+            else:
+                pool_context = FTPPool(PATRIC_FTP, size=ftp_connections)
+                if use_https:
+                    https_context = open_https_client(size=connections)
+            with pool_context as ftp_pool, https_context as https_client:
+                with ftp_pool.connection() as ftp:
+                    remote_info = get_remote_dir_timestamps(
+                        ftp, remote_dirname
+                    )
                 targets = filter_files_on_mdtm(remote_info, local_info)
                 missing_files = get_missing_files(
                     local_dirpath, list(remote_info.keys())
@@ -172,29 +323,30 @@ def sync_single_dir(genomes_dir, genome_id, attempts=3, write_info=True):
                 if len(targets) != 0:
                     # Create the dir only if there is something to download
                     local_dirpath.mkdir(exist_ok=True)
-                    download_genome_targets(ftp, local_dirpath, targets)
+                    if https_client is not None:
+                        download_genome_targets_https(
+                            https_client,
+                            local_dirpath,
+                            targets,
+                            workers=connections,
+                        )
+                    else:
+                        download_genome_targets(
+                            ftp_pool, local_dirpath, targets
+                        )
                 else:
                     _logger.debug("{} is up to date".format(genome_id))
 
             if write_info is True:
                 ftp_info_tsv = local_dirpath / pathlib.Path("ftp_info.tsv")
-                modtimes_df = pd.DataFrame.from_dict(
-                    remote_info, orient="index"
-                )
-                modtimes_df.index.name = "fname"
-                modtimes_df.to_csv(ftp_info_tsv, sep="\t")
+                write_ftp_info(ftp_info_tsv, remote_info)
 
             break
 
-        # Specific handling of the '550 - Missing dir or permission denied'
-        # Breaks and returns the genome_id
-        except ftplib.error_perm as ftp_err:
-            if str(ftp_err).startswith("550"):
-                _logger.debug("Skipping {} ( {} )".format(genome_id, ftp_err))
-                break
-
         # Try to catch CTRL-C if user doesn't want to proceed
         except KeyboardInterrupt:
+            if reuse_connections:
+                reset_worker_connections()
             _logger.error("Ctrl+C signal detected")
             _logger.error(
                 "Removing directory that might contain corrupted files "
@@ -207,13 +359,23 @@ def sync_single_dir(genomes_dir, genome_id, attempts=3, write_info=True):
         # Retry until number of specified attempts and raise eventually
         # Capture text in the generic Exception class
         except Exception as e:
+            # Specific handling of the '550 - Missing dir or permission
+            # denied'. Breaks and returns the genome_id. Any other ftp
+            # error, e.g. a 530, is retried like the rest
+            if is_missing_genome_error(e):
+                _logger.debug("Skipping {} ( {} )".format(genome_id, e))
+                break
+            # The connections might be broken, start over with new ones
+            if reuse_connections:
+                reset_worker_connections()
             if attempt == attempts:
                 _logger.error("Failed syncing {}".format(genome_id))
                 _logger.error(
                     "Removing directory that might contain corrupted files "
                     "at {}".format(local_dirpath)
                 )
-                shutil.rmtree(local_dirpath.resolve())
+                # The dir is only created once there is something to get
+                shutil.rmtree(local_dirpath, ignore_errors=True)
                 raise
             else:
                 _logger.warning(
@@ -230,57 +392,373 @@ def sync_single_dir(genomes_dir, genome_id, attempts=3, write_info=True):
     return genome_id
 
 
-def create_genome_jobs(genome_summary, genomes_dir, processed_genomes=None):
+async def sync_single_dir_async(
+    ftp_pool, genomes_dir, genome_id, attempts=3, write_info=True
+):
+    """Same as sync_single_dir, over the clients of an AsyncFTPPool
+
+    The pool is logged in if it is not, e.g. on its first genome or after
+    a failed attempt closed it
+    """
+    remote_dirname = f"genomes/{genome_id}"
+
+    local_dirpath = genomes_dir / pathlib.Path(genome_id)
+    local_info = get_local_info(local_dirpath)
+
+    for attempt in range(1, attempts + 1):
+        downloading = False
+        try:
+            if not ftp_pool.clients:
+                await ftp_pool.open()
+            remote_info = await get_remote_dir_timestamps_async(
+                ftp_pool.clients[0], remote_dirname
+            )
+            targets = filter_files_on_mdtm(remote_info, local_info)
+            missing_files = get_missing_files(
+                local_dirpath, list(remote_info.keys())
+            )
+
+            if len(missing_files) != 0:
+                targets.extend(missing_files)
+
+            if len(targets) != 0:
+                local_dirpath.mkdir(exist_ok=True)
+                downloading = True
+                await download_genome_targets_async(
+                    ftp_pool, local_dirpath, targets
+                )
+                downloading = False
+            else:
+                _logger.debug("{} is up to date".format(genome_id))
+
+            if write_info is True:
+                ftp_info_tsv = local_dirpath / pathlib.Path("ftp_info.tsv")
+                write_ftp_info(ftp_info_tsv, remote_info)
+
+            break
+
+        # The run was interrupted, e.g. with Ctrl+C
+        except asyncio.CancelledError:
+            if downloading:
+                _logger.error(
+                    "Removing directory that might contain corrupted files "
+                    "at {}".format(local_dirpath)
+                )
+                shutil.rmtree(local_dirpath, ignore_errors=True)
+            raise
+
+        except Exception as e:
+            if is_missing_genome_error(e):
+                _logger.debug("Skipping {} ( {} )".format(genome_id, e))
+                break
+            # The connections might be broken, start over with new ones
+            await ftp_pool.close()
+            if attempt == attempts:
+                _logger.error("Failed syncing {}".format(genome_id))
+                _logger.error(
+                    "Removing directory that might contain corrupted files "
+                    "at {}".format(local_dirpath)
+                )
+                shutil.rmtree(local_dirpath, ignore_errors=True)
+                raise
+            _logger.warning(
+                "Attempt {} / {} for {} failed ( {} )".format(
+                    attempt, attempts, genome_id, e
+                )
+            )
+            _logger.warning(
+                "Sleeping for {}s before retrying".format((attempt + 1) * 60)
+            )
+            await asyncio.sleep((attempt + 1) * 60)
+
+    return genome_id
+
+
+def create_genome_jobs(
+    genome_summary, genomes_dir, processed_genomes=None, skip=False, only=None
+):
+    """
+    Yield the genome ids that will be synced
+
+    Positional arguments:
+      - genome_summary: pathlib.Path: Path to the genome_summary file
+      - genomes_dir: pathlib.Path: The local genomes directory
+
+    Keyword arguments:
+      - processed_genomes: set: Genome ids found in the cache
+      - skip: bool: If this is True, genome ids in processed_genomes are
+        not yielded
+      - only: set: If given, only genome ids in it are yielded
 
-    all_genomes = genomes_from_summary(genome_summary)
-    all_genome_jobs = []
+    Yield:
+      - genome_id: str: A genome id from the genome_summary
+    """
+    genome_jobs = genomes_from_summary(genome_summary)
 
-    if processed_genomes:
+    if only is not None:
+        _logger.debug("Restricting jobs to {} genomes".format(len(only)))
+        genome_jobs = (g for g in genome_jobs if g in only)
+
+    if skip and processed_genomes:
         _logger.debug(
             "{} genomes will be skipped".format(len(processed_genomes))
         )
-        all_genomes = sorted(
-            [i for i in all_genomes if i not in processed_genomes]
+        genome_jobs = (g for g in genome_jobs if g not in processed_genomes)
+
+    yield from genome_jobs
+
+
+def record_processed_genome(fout, genome_id):
+    """Append a processed genome id to the open log file
+
+    The id is flushed right away, so it is on disk if the run is killed
+    """
+    fout.write("{}\n".format(genome_id))
+    fout.flush()
+
+
+def compact_processed_genomes(
+    cache_dir, processed_genomes, min_ratio=2, force=False
+):
+    """
+    Fold the processed genomes log into the gzipped cache, without
+    duplicate genome ids.
+
+    Processed genomes are appended to the plain text log as they finish,
+    so ids that are synced again are repeated. Once the log and the
+    gzipped cache together hold more than `min_ratio` times the unique
+    ids, or with force, the gzipped cache is rewritten with all
+    processed_genomes and the log is removed. The new file replaces the
+    old one in a single rename.
+
+    Positional arguments:
+      - cache_dir: pathlib.Path: The cache directory
+      - processed_genomes: set: All processed genome ids
+
+    Keyword arguments:
+      - min_ratio: int: Compact when the cached ids exceed this many times
+        the unique ids
+      - force: bool: Compact regardless of min_ratio
+
+    Return:
+      - compacted: bool: True if the file was rewritten
+    """
+    processed_genomes_txt = cache_dir / PROCESSED_TXT_GZ
+    log_txt = cache_dir / PROCESSED_TXT
+    cache_files = [f for f in (processed_genomes_txt, log_txt) if f.exists()]
+    if not cache_files:
+        return False
+
+    if not force:
+        cached_ids = sum(len(load_cached_genomes(f)) for f in cache_files)
+        if cached_ids <= min_ratio * len(processed_genomes):
+            _logger.debug(
+                "No need to compact {}".format(processed_genomes_txt)
+            )
+            return False
+
+    _logger.info("Compacting {}".format(processed_genomes_txt))
+    # Write a temporary file and move it in place, so an interrupted run
+    # leaves the old cache intact
+    tmp_txt = processed_genomes_txt.with_name(
+        processed_genomes_txt.name + ".tmp"
+    )
+    # Sorted ids make the cache easy to diff between runs
+    with gzip.open(tmp_txt, "wt", compresslevel=1) as fout:
+        if processed_genomes:
+            fout.write("\n".join(sorted(processed_genomes)))
+            fout.write("\n")
+    tmp_txt.replace(processed_genomes_txt)
+    # If this is interrupted, the ids of the log are also in the new file
+    if log_txt.exists():
+        log_txt.unlink()
+    return True
+
+
+def _sync_in_processes(sync, all_genome_jobs, workers):
+    """Yield the genome ids synced in a pool of processes
+
+    Jobs are sent to the processes in chunks to save on IPC round-trips.
+    The results of a chunk only come back once all of it is synced, so
+    chunks are capped to PROCESS_CHUNK_MAX genomes. Otherwise a failed
+    run would lose the progress of many finished genomes.
+    """
+    chunksize = max(1, len(all_genome_jobs) // (workers * 8))
+    chunksize = min(chunksize, PROCESS_CHUNK_MAX)
+    with mp.Pool(processes=workers) as pool:
+        yield from pool.imap_unordered(
+            sync, all_genome_jobs, chunksize=chunksize
         )
-        _logger.debug("Continuing with {} genomes".format(len(all_genomes)))
 
-    all_genome_jobs = all_genomes
-    #    all_genome_jobs = [
-    #        (genome_id, pathlib.Path(genomes_dir) / pathlib.Path(genome_id))
-    #        for genome_id in all_genomes
-    #    ]
-    #
-    return all_genome_jobs
+
+def _sync_in_threads(sync, all_genome_jobs, workers):
+    """Yield the genome ids synced in a pool of threads, as they finish
+
+    Transfers wait on sockets with the GIL released, so threads give the
+    same concurrency as processes for a fraction of the memory. At most
+    MIRROR_BATCH jobs are submitted at any time. The ftp connections the
+    threads kept open are closed when all jobs are done.
+    """
+    jobs = iter(all_genome_jobs)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            pending = {
+                ex.submit(sync, job) for job in islice(jobs, MIRROR_BATCH)
+            }
+            try:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                    for job in islice(jobs, len(done)):
+                        pending.add(ex.submit(sync, job))
+            finally:
+                for future in pending:
+                    future.cancel()
+    finally:
+        close_worker_connections()
+
+
+MIRROR_BACKENDS = {
+    "process": _sync_in_processes,
+    "thread": _sync_in_threads,
+}
 
 
 def mirror_genomes_dir(
-    all_genome_jobs, local_genomes_dir, cache_dir, procs=1, progress_bar=True,
+    all_genome_jobs,
+    local_genomes_dir,
+    cache_dir,
+    procs=1,
+    progress_bar=True,
+    connections=1,
+    backend="process",
+    transport="ftp",
 ):
+    """Sync all genome jobs with procs parallel workers
+
+    The backend is one of `process`, `thread` or `async` and sets the kind
+    of workers. See `async_mirror_genomes_dir` for the latter. The
+    transport is `ftp` or `https`, see `sync_single_dir`.
+
+    Each genome id is appended to the processed genomes cache in the
+    cache_dir as soon as it is synced, so a failed run can be resumed.
+    """
+    # Fail before any genome is tried, instead of retrying each of them
+    if transport == "https":
+        require_httpx()
+
+    if backend == "async":
+        if transport != "ftp":
+            raise ValueError("The async backend only supports ftp")
+        return async_mirror_genomes_dir(
+            all_genome_jobs,
+            local_genomes_dir,
+            cache_dir,
+            procs=procs,
+            progress_bar=progress_bar,
+            connections=connections,
+        )
+
+    sync_all = MIRROR_BACKENDS[backend]
 
+    # Each worker logs in once and keeps its connections for all the
+    # genomes it syncs
     parallel_sync = partial(
-        sync_single_dir, local_genomes_dir, write_info=True, attempts=3
+        sync_single_dir,
+        local_genomes_dir,
+        write_info=True,
+        attempts=3,
+        connections=connections,
+        reuse_connections=True,
+        transport=transport,
     )
 
+    processed_genomes_txt = cache_dir / PROCESSED_TXT
     results = []
-    try:
-        with mp.Pool(processes=procs) as pool:
-            if progress_bar:
-                pbar = tqdm(total=len(all_genome_jobs))
-                for res in pool.imap_unordered(parallel_sync, all_genome_jobs):
-                    pbar.update()
-                    results.append(res)
-            else:
-                for res in pool.imap_unordered(parallel_sync, all_genome_jobs):
-                    results.append(res)
-    except Exception:
-        _logger.error("An error occured. Writing processed_genomes to .cache")
-        processed_genomes_txt = cache_dir / pathlib.Path("processed_genomes.txt")
-        if processed_genomes_txt.exists():
-            open_mode = 'a'
-        else:
-            open_mode = 'w'
-        with open(processed_genomes_txt, mode=open_mode) as fout:
-            for genome_id in results:
-                fout.write("{}\n".format(genome_id))
-        raise
+    with open_processed_genomes(cache_dir) as fout:
+        try:
+            pbar = tqdm(total=len(all_genome_jobs), disable=not progress_bar)
+            for res in sync_all(parallel_sync, all_genome_jobs, procs):
+                pbar.update()
+                results.append(res)
+                record_processed_genome(fout, res)
+            pbar.close()
+        except Exception:
+            _logger.error(
+                "An error occured. Processed genomes are stored in "
+                "{}".format(processed_genomes_txt)
+            )
+            raise
+    return results
+
+
+async def _sync_genomes_async(
+    all_genome_jobs, sync, workers, connections, on_done
+):
+    """Run `workers` coroutines that sync the genome jobs one after another
+
+    Each coroutine logs in once with an AsyncFTPPool of `connections`
+    clients and keeps it for all the genomes it syncs. `on_done` is called
+    with each finished genome id.
+    """
+    jobs = iter(all_genome_jobs)
+
+    async def worker():
+        ftp_pool = AsyncFTPPool(PATRIC_FTP, size=connections)
+        try:
+            # The iterator is shared, all coroutines run in one thread
+            for genome_id in jobs:
+                on_done(await sync(ftp_pool, genome_id))
+        finally:
+            await ftp_pool.close()
+
+    await asyncio.gather(*(worker() for _ in range(max(1, workers))))
+
+
+def async_mirror_genomes_dir(
+    all_genome_jobs,
+    local_genomes_dir,
+    cache_dir,
+    procs=1,
+    progress_bar=True,
+    connections=1,
+):
+    """Same as mirror_genomes_dir, with aioftp on an event loop
+
+    procs ftp sessions run concurrently in a single thread, so it can be
+    set much higher than the number of cores. This requires aioftp, see
+    the `async` extra.
+    """
+    require_aioftp()
+
+    async def sync(ftp_pool, genome_id):
+        return await sync_single_dir_async(
+            ftp_pool, local_genomes_dir, genome_id, attempts=3
+        )
+
+    processed_genomes_txt = cache_dir / PROCESSED_TXT
+    results = []
+    with open_processed_genomes(cache_dir) as fout:
+        pbar = tqdm(total=len(all_genome_jobs), disable=not progress_bar)
+
+        def on_done(genome_id):
+            results.append(genome_id)
+            record_processed_genome(fout, genome_id)
+            pbar.update()
+
+        try:
+            asyncio.run(
+                _sync_genomes_async(
+                    all_genome_jobs, sync, procs, connections, on_done
+                )
+            )
+        except Exception:
+            _logger.error(
+                "An error occured. Processed genomes are stored in "
+                "{}".format(processed_genomes_txt)
+            )
+            raise
+        finally:
+            pbar.close()
     return results
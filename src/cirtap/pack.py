@@ -1,9 +1,18 @@
+from contextlib import contextmanager
+import hashlib
+import io
 import tarfile
-import pathlib
 import logging
+import os
+import shutil
+import stat
+import subprocess
 
 _logger = logging.getLogger(__name__)
 
+# Files up to this size are hashed when deduplicating
+DEDUP_MAX_SIZE = 16 * 1024
+
 
 def genome_ids_from_text(txt_file):
     """Parse single column text file to a set"""
@@ -22,22 +31,129 @@ def genome_ids_from_text(txt_file):
     return genome_ids_set
 
 
-def pack_genome_data(genomes_dir, ids_text, tar_out):
-    """Create a gzipped tarfile from the ids in the text file"""
+@contextmanager
+def open_tar_gz(tar_out, jobs=0):
+    """Open a gzipped tarfile for writing
+
+    If pigz is on the PATH the tar stream is piped through it, so
+    compression runs in `jobs` threads. Otherwise python's single
+    threaded gzip is used.
+
+    Positional arguments:
+      tar_out: pathlib.Path: The archive to write
+      jobs: int: Number of compression threads for pigz. 0 uses all cores
+
+    Return:
+      fout: tarfile.TarFile: Open for writing
+    """
+    pigz = shutil.which("pigz")
+    if pigz is None:
+        _logger.debug("pigz was not found, compressing with a single thread")
+        with tarfile.open(tar_out, "w:gz") as fout:
+            yield fout
+        return
+
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+    _logger.debug("Compressing with {} in {} threads".format(pigz, jobs))
+    with open(tar_out, "wb") as fp:
+        proc = subprocess.Popen(
+            [pigz, "-p", str(jobs)], stdin=subprocess.PIPE, stdout=fp
+        )
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode="w|") as fout:
+                yield fout
+        finally:
+            proc.stdin.close()
+            returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, proc.args)
+
+
+def entry_tarinfo(entry, arcname):
+    """Build a TarInfo for a regular file from its os.DirEntry
+
+    This reuses the stat of the entry, instead of the extra lstat and
+    user/group name lookups that TarFile.add does for every file
+    """
+    st = entry.stat(follow_symlinks=False)
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.size = st.st_size
+    tarinfo.mtime = st.st_mtime
+    tarinfo.mode = stat.S_IMODE(st.st_mode)
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    return tarinfo
+
+
+def add_file(fout, entry, arcname, seen=None):
+    """Add a regular file to the archive
+
+    If seen is a dict, small files are looked up in it by the digest of
+    their contents. A file already in there is written as a hard link to
+    the first member with the same contents.
+
+    Positional arguments:
+      fout: tarfile.TarFile: The archive to add to
+      entry: os.DirEntry: The file to add
+      arcname: str: Name of the member in the archive
+      seen: dict or None: Digest to member name, updated in place
+
+    Return:
+      linked: bool: True if the file was stored as a link
+    """
+    tarinfo = entry_tarinfo(entry, arcname)
+    if seen is None or not 0 < tarinfo.size <= DEDUP_MAX_SIZE:
+        with open(entry.path, "rb") as fin:
+            fout.addfile(tarinfo, fin)
+        return False
+
+    with open(entry.path, "rb") as fin:
+        data = fin.read()
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    if digest in seen:
+        tarinfo.type = tarfile.LNKTYPE
+        tarinfo.linkname = seen[digest]
+        tarinfo.size = 0
+        fout.addfile(tarinfo)
+        return True
+
+    seen[digest] = arcname
+    fout.addfile(tarinfo, io.BytesIO(data))
+    return False
+
+
+def pack_genome_data(genomes_dir, ids_text, tar_out, jobs=0, dedup=False):
+    """Create a gzipped tarfile from the ids in the text file
+
+    With dedup, small files with the same contents as one already in the
+    archive are stored as hard links to the first copy
+    """
 
     genome_ids = genome_ids_from_text(ids_text)
+    # blake2b digest -> name of the first member with these contents
+    seen = {} if dedup else None
+    deduped = 0
 
-    with tarfile.open(tar_out, "w:gz") as fout:
+    with open_tar_gz(tar_out, jobs) as fout:
         for genome_id in genome_ids:
-            full_path = genomes_dir / pathlib.Path(genome_id)
+            full_path = os.path.join(genomes_dir, genome_id)
             _logger.debug(full_path)
-            if full_path.exists():
-                for f in full_path.iterdir():
-                    leaf = f.name
-                    tar_name = f"genomes/{genome_id}/{leaf}"
-                    _logger.debug("Compressing {}".format(f.resolve()))
-                    fout.add(f, arcname=tar_name)
-            else:
+            try:
+                it = os.scandir(full_path)
+            except FileNotFoundError:
                 _logger.warning(f"No data found for genome id {genome_id}")
+                continue
+
+            with it:
+                for entry in it:
+                    tar_name = f"genomes/{genome_id}/{entry.name}"
+                    _logger.debug("Compressing {}".format(entry.path))
+                    if entry.is_file(follow_symlinks=False):
+                        deduped += add_file(fout, entry, tar_name, seen)
+                    else:
+                        fout.add(entry.path, arcname=tar_name)
 
+    if dedup:
+        _logger.info("Stored {} duplicate files as links".format(deduped))
     return
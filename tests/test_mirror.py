@@ -0,0 +1,190 @@
+import asyncio
+import ftplib
+import gzip
+from contextlib import nullcontext
+
+import pytest
+
+import cirtap.mirror
+from cirtap.mirror import (
+    PROCESSED_TXT,
+    PROCESSED_TXT_GZ,
+    check_cache_dir,
+    compact_processed_genomes,
+    open_processed_genomes,
+    record_processed_genome,
+    sync_single_dir,
+)
+
+
+def killed_gzip_cache(processed_txt_gz, genome_ids):
+    """Write a gzipped cache the way older versions did and kill the run
+
+    Each id was flushed as it was appended, so the file ends without the
+    gzip trailer when the run is killed
+    """
+    fout = gzip.open(processed_txt_gz, "at", compresslevel=1)
+    for genome_id in genome_ids:
+        fout.write("{}\n".format(genome_id))
+        fout.flush()
+    killed = processed_txt_gz.read_bytes()
+    fout.close()
+    processed_txt_gz.write_bytes(killed)
+
+
+def resume(cache_dir, genome_ids):
+    """Load the cache and record the genome_ids like a mirror run"""
+    processed_genomes = check_cache_dir(cache_dir)
+    with open_processed_genomes(cache_dir) as fout:
+        for genome_id in genome_ids:
+            record_processed_genome(fout, genome_id)
+    return processed_genomes
+
+
+def test_kill_then_resume_then_resume(tmp_path):
+    cache_dir = tmp_path / ".cache"
+    cache_dir.mkdir()
+    first = ["{}.1".format(i) for i in range(100)]
+    killed_gzip_cache(cache_dir / PROCESSED_TXT_GZ, first)
+
+    assert resume(cache_dir, ["a.1", "b.1"]) == set(first)
+    assert resume(cache_dir, ["c.1"]) == set(first) | {"a.1", "b.1"}
+    assert check_cache_dir(cache_dir) == set(first) | {"a.1", "b.1", "c.1"}
+
+
+def test_partial_line_of_killed_run_is_dropped(tmp_path):
+    (tmp_path / PROCESSED_TXT).write_text("a.1\n1234.1")
+
+    assert resume(tmp_path, ["c.1"]) == {"a.1"}
+    assert (tmp_path / PROCESSED_TXT).read_text() == "a.1\nc.1\n"
+
+
+def test_partial_only_line_is_dropped(tmp_path):
+    (tmp_path / PROCESSED_TXT).write_text("1234.1")
+
+    assert resume(tmp_path, ["c.1"]) == set()
+    assert check_cache_dir(tmp_path) == {"c.1"}
+
+
+def test_compact_folds_log_into_gzipped_cache(tmp_path):
+    resume(tmp_path, ["a.1", "b.1", "a.1"])
+    processed_genomes = check_cache_dir(tmp_path)
+
+    assert compact_processed_genomes(tmp_path, processed_genomes, force=True)
+    assert not (tmp_path / PROCESSED_TXT).exists()
+    with gzip.open(tmp_path / PROCESSED_TXT_GZ, "rt") as fin:
+        assert fin.read() == "a.1\nb.1\n"
+    assert check_cache_dir(tmp_path) == {"a.1", "b.1"}
+
+
+def test_gzipped_cache_appended_after_a_kill_is_read(tmp_path):
+    first = ["{}.1".format(i) for i in range(10000)]
+    killed_gzip_cache(tmp_path / PROCESSED_TXT_GZ, first)
+    # Older versions appended a new gzip member after the broken one
+    with gzip.open(tmp_path / PROCESSED_TXT_GZ, "at") as fout:
+        fout.write("a.1\n")
+
+    # Ids are read up to where the file breaks, the rest is synced again
+    processed_genomes = check_cache_dir(tmp_path)
+    assert set(first[:5000]) <= processed_genomes <= set(first)
+
+    processed_genomes.add("a.1")
+    assert compact_processed_genomes(tmp_path, processed_genomes, min_ratio=0)
+    assert check_cache_dir(tmp_path) == processed_genomes
+
+
+def test_compact_once_the_cache_grows_past_min_ratio(tmp_path):
+    genome_ids = ["{}.1".format(i) for i in range(100)]
+    for run in range(3):
+        resume(tmp_path, genome_ids)
+        processed_genomes = check_cache_dir(tmp_path)
+        compacted = compact_processed_genomes(tmp_path, processed_genomes)
+        # Compacted on the third run, when 300 ids are cached
+        assert compacted is (run == 2)
+
+    assert not (tmp_path / PROCESSED_TXT).exists()
+    assert check_cache_dir(tmp_path) == set(genome_ids)
+
+
+class FakeFTPPool:
+    def connection(self):
+        return nullcontext(None)
+
+
+def failing_listing(reply):
+    def get_remote_dir_timestamps(ftp, remote_dir_name):
+        raise ftplib.error_perm(reply)
+
+    return get_remote_dir_timestamps
+
+
+def test_sync_raises_and_resets_on_other_ftp_errors(tmp_path, monkeypatch):
+    resets = []
+    monkeypatch.setattr(
+        cirtap.mirror, "get_worker_ftp_pool", lambda *_: FakeFTPPool()
+    )
+    monkeypatch.setattr(
+        cirtap.mirror, "reset_worker_connections", lambda: resets.append(1)
+    )
+    monkeypatch.setattr(
+        cirtap.mirror,
+        "get_remote_dir_timestamps",
+        failing_listing("530 Not logged in"),
+    )
+    monkeypatch.setattr(cirtap.mirror.time, "sleep", lambda _: None)
+
+    with pytest.raises(ftplib.error_perm):
+        sync_single_dir(tmp_path, "1234.5", reuse_connections=True)
+    assert len(resets) == 3
+
+
+def test_sync_skips_missing_genome(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        cirtap.mirror, "get_worker_ftp_pool", lambda *_: FakeFTPPool()
+    )
+    monkeypatch.setattr(
+        cirtap.mirror,
+        "get_remote_dir_timestamps",
+        failing_listing("550 No such file or directory"),
+    )
+
+    assert sync_single_dir(tmp_path, "1234.5", reuse_connections=True) == (
+        "1234.5"
+    )
+
+
+def test_async_sync_downloads_and_skips_missing(tmp_path):
+    aioftp = pytest.importorskip("aioftp")
+    from cirtap.common import AsyncFTPPool, get_local_info
+    from cirtap.mirror import sync_single_dir_async
+
+    remote = tmp_path / "remote"
+    (remote / "genomes" / "1234.5").mkdir(parents=True)
+    (remote / "genomes" / "1234.5" / "1234.5.fna").write_text(">a\nACGT\n")
+    (remote / "genomes" / "1234.5" / "1234.5.PATRIC.faa").write_text(">b\nM\n")
+    local = tmp_path / "genomes"
+    local.mkdir()
+
+    async def run():
+        server = aioftp.Server([aioftp.User(base_path=remote)])
+        await server.start("127.0.0.1", 0)
+        port = server.address[1]
+        try:
+            ftp_pool = AsyncFTPPool("127.0.0.1", size=2, port=port)
+            try:
+                synced = await sync_single_dir_async(ftp_pool, local, "1234.5")
+                missing = await sync_single_dir_async(ftp_pool, local, "9.9")
+            finally:
+                await ftp_pool.close()
+        finally:
+            await server.close()
+        return synced, missing
+
+    assert asyncio.run(run()) == ("1234.5", "9.9")
+    assert (local / "1234.5" / "1234.5.fna").read_text() == ">a\nACGT\n"
+    assert (local / "1234.5" / "1234.5.PATRIC.faa").read_text() == ">b\nM\n"
+    assert set(get_local_info(local / "1234.5")) == {
+        "1234.5.fna",
+        "1234.5.PATRIC.faa",
+    }
+    assert not (local / "9.9").exists()